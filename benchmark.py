@@ -0,0 +1,424 @@
+import argparse
+import json
+import platform
+import subprocess
+import torch
+import torch.nn.functional as F
+from time import time
+from const import *
+from utils import default_device
+from trainers import scheduler_step_mode
+from model.resnet import ResNet
+from model.base import HyperBuffer, iter_tensors
+from model.blank import BlankLR
+from model.adaptdetection import AdaptDectectionLR, AdaptDectectionAdamLR, AdaptDectectionMomentumLR, LayerwiseAdaptDectectionLR
+from model.hypergradient import HyperGradientLR, HyperGradientAdamLR, HyperGradientMomentumLR
+
+
+def synchronize(device):
+    if torch.device(device).type == "cuda":
+        torch.cuda.synchronize(device)
+    return
+
+
+def fill_grads(model, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    for param in model.parameters():
+        # grads take their param's memory format, like the ones autograd accumulates
+        param.grad = torch.empty_like(param).copy_(torch.randn(param.size(), generator=generator))
+    return
+
+
+def time_fn(fn, steps, device, warmup=3):
+    for _ in range(warmup):
+        fn()
+    synchronize(device)
+    st_time = time()
+    for _ in range(steps):
+        fn()
+    synchronize(device)
+    return (time()-st_time)/steps
+
+
+# bytes allocated at the peak of fn on top of what was live before it
+def peak_memory(fn, device):
+    return memory_stats(fn, device)["peak_bytes"]
+
+
+# peak bytes on top of what was live before fn, and the number and bytes of its allocations
+def memory_stats(fn, device):
+    if torch.device(device).type == "cuda":
+        synchronize(device)
+        base = torch.cuda.memory_allocated(device)
+        before = torch.cuda.memory_stats(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        fn()
+        synchronize(device)
+        after = torch.cuda.memory_stats(device)
+        return {"peak_bytes": torch.cuda.max_memory_allocated(device)-base,
+                "allocations": after["allocation.all.allocated"]-before["allocation.all.allocated"],
+                "allocated_bytes": after["allocated_bytes.all.allocated"]-before["allocated_bytes.all.allocated"]}
+    # on cpu from the profiler's op level memory usage: every op counts the bytes it allocated net of
+    # what it freed itself ([memory] entries are frees outside any op), so allocations counts the
+    # calls of allocating ops and the peak is taken at op starts
+    with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    averages = prof.key_averages()
+    current = peak = 0
+    for event in sorted(prof.events(), key=lambda event: event.time_range.start):
+        current += event.self_cpu_memory_usage
+        peak = max(peak, current)
+    return {"peak_bytes": peak,
+            "allocations": sum(average.count for average in averages if average.self_cpu_memory_usage > 0),
+            "allocated_bytes": sum(max(average.self_cpu_memory_usage, 0) for average in averages)}
+
+
+# per-step cost of AdaptDectectionLR.buffer_step (loop vs foreach) relative to a bare optimizer.step()
+def bench_buffer_step(layerwise=True, steps=20, device="cpu", num_classes=100):
+    model = ResNet(3, 32, num_classes).to(device)
+    fill_grads(model)
+    params = model.parameters_layerwise() if layerwise else model.parameters()
+    optimizer = torch.optim.SGD(params, lr=0.1, weight_decay=1e-4)
+    step_time = time_fn(optimizer.step, steps, device)
+    res = {"layerwise": layerwise, "device": device, "num_groups": len(optimizer.param_groups),
+           "optimizer_step": step_time}
+    schedulers = {}
+    for foreach in [False, True]:
+        scheduler = AdaptDectectionLR(optimizer, foreach=foreach)
+        buffer_time = time_fn(scheduler.buffer_step, steps, device)
+        name = "foreach" if foreach else "loop"
+        res[f"buffer_step_{name}"] = buffer_time
+        res[f"overhead_{name}"] = buffer_time/step_time
+        res["scheduler_bytes"] = scheduler.memory_footprint()["total"]
+        schedulers[name] = scheduler
+    # both engines saw the same gradients the same number of times. the accumulators match bit for
+    # bit, the lr grads up to the rounding of their different summation order
+    loop, foreach = schedulers["loop"], schedulers["foreach"]
+    res["identical"] = torch.equal(loop.accumulated_param_grad.flat, foreach.accumulated_param_grad.flat)
+    loop_grads, foreach_grads = [torch.stack([torch.as_tensor(grad, dtype=torch.float32, device=device) for grad in scheduler.last_lr_grad])
+                                 for scheduler in (loop, foreach)]
+    res["lr_grad_rel_error"] = float(torch.norm(foreach_grads-loop_grads)/torch.norm(loop_grads))
+    return res
+
+
+# step time and peak memory of the adam direction recomputation, per parameter loop vs foreach
+def bench_adam_direction(layerwise=False, steps=5, device="cpu", num_classes=100):
+    model = ResNet(3, 32, num_classes).to(device)
+    fill_grads(model)
+    params = model.parameters_layerwise() if layerwise else model.parameters()
+    optimizer = torch.optim.Adam(params, lr=0.001, weight_decay=1e-4)
+    optimizer.step()
+    res = {"layerwise": layerwise, "device": device, "num_groups": len(optimizer.param_groups),
+           "optimizer_step": time_fn(optimizer.step, steps, device)}
+    for cls in [AdaptDectectionAdamLR, HyperGradientAdamLR]:
+        lr_grads = {}
+        for foreach in [False, True]:
+            scheduler = cls(optimizer, foreach=foreach)
+            fn = scheduler.buffer_step if hasattr(scheduler, "buffer_step") else scheduler.get_lr
+            name = f"{cls.__name__}_{'foreach' if foreach else 'loop'}"
+            res[name] = {"time": time_fn(fn, steps, device), "peak_bytes": peak_memory(fn, device)}
+            lr_grads[foreach] = scheduler.last_lr_grad if hasattr(scheduler, "buffer_step") else scheduler.get_lr()
+        res[f"{cls.__name__}_identical"] = all(torch.equal(torch.as_tensor(a), torch.as_tensor(b))
+                                               for a, b in zip(lr_grads[False], lr_grads[True]))
+    return res
+
+
+# hypergradient error of each storage mode against fp32, and the bytes it holds, over steps
+# batches (default a cifar10 epoch at batch size 128). AdaptDectectionLR sums its accumulator over
+# all steps, so its bf16/fp16 error grows with them. HyperGradientLR overwrites its buffer every
+# step, its error is taken over the lr grads of all steps
+def bench_storage(layerwise=False, steps=391, device="cpu", batch_size=8, sketch_dims=(1024, 16384), num_classes=100):
+    torch.manual_seed(0)
+    model = ResNet(3, 32, num_classes).to(device)
+    params = model.parameters_layerwise() if layerwise else model.parameters()
+    optimizer = torch.optim.SGD(params, lr=0.1, weight_decay=1e-4)
+    sketches = {f"sketch{sketch_dim}": {"sketch_dim": sketch_dim} for sketch_dim in sketch_dims}
+    dtypes = {"fp32": {}, "bf16": {"buffer_dtype": torch.bfloat16}, "fp16": {"buffer_dtype": torch.float16}}
+    modes = {AdaptDectectionLR: {**dtypes, **sketches}, HyperGradientLR: {**dtypes, **sketches}}
+    schedulers = {(cls, name): cls(optimizer, **({"foreach": False} if cls is AdaptDectectionLR else {}), **kwargs)
+                  for cls, cls_modes in modes.items() for name, kwargs in cls_modes.items()}
+    hd_lr_grads = {key: [] for key in schedulers if key[0] is HyperGradientLR}
+    # a fixed batch keeps successive grads correlated, like consecutive steps of real training
+    imgs = torch.randn(batch_size, 3, 32, 32, device=device)
+    label = torch.randint(0, num_classes, (batch_size,), device=device)
+    for _ in range(steps):
+        loss = F.cross_entropy(model(imgs), label)
+        optimizer.zero_grad()
+        loss.backward()
+        optimizer.step()
+        for key, scheduler in schedulers.items():
+            if key in hd_lr_grads:
+                hd_lr_grads[key].append(torch.stack([torch.as_tensor(grad, dtype=torch.float32, device=device) for grad in scheduler.lr_grads()]))
+            else:
+                scheduler.buffer_step(steps)
+    lr_grads = {key: torch.stack(hd_lr_grads[key]) if key in hd_lr_grads else
+                torch.stack([torch.as_tensor(grad, dtype=torch.float32, device=device) for grad in scheduler.last_lr_grad])
+                for key, scheduler in schedulers.items()}
+    res = {"layerwise": layerwise, "device": device, "num_groups": len(optimizer.param_groups), "steps": steps}
+    for (cls, name), scheduler in schedulers.items():
+        exact = lr_grads[(cls, "fp32")]
+        res[f"{cls.__name__}_{name}"] = {"bytes": scheduler.memory_footprint()["total"],
+                                         "rel_error": float(torch.norm(lr_grads[(cls, name)]-exact)/torch.norm(exact))}
+    return res
+
+
+# bias and variance of the sketched and sampled hypergradient estimators relative to the exact
+# per group dot of a stored direction with the grad, over draws of their randomness, and the time
+# of one HyperGradientLR pass (dot, then store the grad) with each
+def bench_estimators(layerwise=False, draws=20, steps=5, device="cpu", rates=(0.01, 0.1), sketch_dims=(1024,), num_classes=100):
+    torch.manual_seed(0)
+    model = ResNet(3, 32, num_classes).to(device)
+    params = model.parameters_layerwise() if layerwise else model.parameters()
+    optimizer = torch.optim.SGD(params, lr=0.1)
+    groups = optimizer.param_groups
+    # a stored direction correlated with the grad, like consecutive grads of real training
+    fill_grads(model)
+    previous = [[param.grad+torch.randn_like(param.grad) for param in group["params"]] for group in groups]
+    grads = [[param.grad for param in group["params"]] for group in groups]
+
+    def store(buffer, values):
+        for lr_idx, group_values in enumerate(values):
+            for i, value in enumerate(group_values):
+                buffer.copy_(lr_idx, i, value)
+        return
+
+    def lr_grads(buffer):
+        return torch.stack([sum(torch.as_tensor(buffer.dot(lr_idx, i, grad), device=device) for i, grad in enumerate(group_grads))
+                            for lr_idx, group_grads in enumerate(grads)])
+
+    def hypergradient_step(buffer):
+        lr_grads(buffer)
+        store(buffer, grads)
+        buffer.advance()
+        return
+
+    modes = {"exact": {}}
+    for sketch_dim in sketch_dims:
+        modes[f"sketch{sketch_dim}"] = {"sketch_dim": sketch_dim}
+    for rate in rates:
+        modes[f"coordinate{rate}"] = {"sample_rate": rate, "sample_mode": COORDINATE}
+        modes[f"param{rate}"] = {"sample_rate": rate, "sample_mode": PARAM}
+    exact = None
+    res = {"layerwise": layerwise, "device": device, "num_groups": len(groups), "draws": draws}
+    for name, kwargs in modes.items():
+        estimates = []
+        for draw in range(draws if kwargs else 1):
+            buffer = HyperBuffer(groups, seed=draw, **kwargs)
+            store(buffer, previous)
+            estimates.append(lr_grads(buffer))
+        estimates = torch.stack(estimates)
+        if exact is None:
+            exact = estimates[0]
+        scale = torch.sum(exact**2)
+        buffer = HyperBuffer(groups, **kwargs)
+        storages = {tensor.untyped_storage().data_ptr(): tensor.untyped_storage().nbytes() for tensor in iter_tensors(buffer)}
+        res[name] = {"rel_bias": float(torch.sum((estimates.mean(0)-exact)**2)/scale),
+                     "rel_variance": float(torch.sum(estimates.var(0, unbiased=False), 0).sum()/scale),
+                     "time": time_fn(lambda: hypergradient_step(buffer), steps, device),
+                     "bytes": sum(storages.values())}
+    return res
+
+
+# optimizer.step() plus buffer_step() of adapt detection: model wise (one group), layer wise with a
+# param group per layer, and layer wise lrs on one group with LayerwiseAdaptDectectionLR
+def bench_layerwise_lr(steps=10, device="cpu", num_classes=100):
+    model = ResNet(3, 32, num_classes).to(device)
+    fill_grads(model)
+    grads = [param.grad.clone() for param in model.parameters()]
+    res = {"device": device, "num_layers": len(model.parameters_layerwise())}
+    for name in ["modelwise", "layerwise_groups", "layerwise_vector"]:
+        params = model.parameters_layerwise() if name == "layerwise_groups" else model.parameters()
+        optimizer = torch.optim.SGD(params, lr=0.1, weight_decay=1e-4)
+        if name == "layerwise_vector":
+            scheduler = LayerwiseAdaptDectectionLR(optimizer, model.parameters_layerwise())
+        else:
+            scheduler = AdaptDectectionLR(optimizer, foreach=True)
+
+        def step():
+            # the pre hook of the layerwise scheduler scales the grads in place
+            for param, grad in zip(model.parameters(), grads):
+                param.grad.copy_(grad)
+            optimizer.step()
+            scheduler.buffer_step(steps)
+            return
+        res[name] = {"num_groups": len(optimizer.param_groups), "step": time_fn(step, steps, device)}
+    return res
+
+
+# images/sec of a full adapt detection train step and the buffer_step share of it, NCHW vs channels_last
+def bench_memory_format(device="cpu", steps=5, batch_size=64, num_classes=100):
+    res = {"device": device, "batch_size": batch_size}
+    for memory_format in [torch.contiguous_format, torch.channels_last]:
+        torch.backends.cudnn.benchmark = memory_format == torch.channels_last
+        torch.manual_seed(0)
+        model = ResNet(3, 32, num_classes).to(device, memory_format=memory_format)
+        optimizer = torch.optim.SGD(model.parameters_layerwise(), lr=0.1, weight_decay=1e-4)
+        scheduler = AdaptDectectionLR(optimizer)
+        imgs = torch.randn(batch_size, 3, 32, 32, device=device).contiguous(memory_format=memory_format)
+        label = torch.randint(0, num_classes, (batch_size,), device=device)
+
+        def train_step():
+            loss = F.cross_entropy(model(imgs), label)
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            scheduler.buffer_step()
+        step_time = time_fn(train_step, steps, device, warmup=2)
+        name = "channels_last" if memory_format == torch.channels_last else "nchw"
+        res[name] = {"images_per_sec": batch_size/step_time, "step": step_time,
+                     "buffer_step": time_fn(scheduler.buffer_step, steps, device),
+                     # every accumulator walks memory like its param
+                     "matching_strides": all(view.stride() == param.stride()
+                                             for views, group in zip(scheduler.accumulated_param_grad.views, optimizer.param_groups)
+                                             for view, param in zip(views, group["params"]))}
+    torch.backends.cudnn.benchmark = False
+    return res
+
+
+# every scheduler in model/ with the optimizer it is written for
+SCHEDULERS = {
+    "BlankLR": (BlankLR, torch.optim.SGD, {"lr": 0.1, "weight_decay": 1e-4}),
+    "HyperGradientLR": (HyperGradientLR, torch.optim.SGD, {"lr": 0.1, "weight_decay": 1e-4}),
+    "HyperGradientMomentumLR": (HyperGradientMomentumLR, torch.optim.SGD, {"lr": 0.1, "momentum": 0.9, "weight_decay": 1e-4}),
+    "HyperGradientAdamLR": (HyperGradientAdamLR, torch.optim.Adam, {"lr": 0.001, "weight_decay": 1e-4}),
+    "AdaptDectectionLR": (AdaptDectectionLR, torch.optim.SGD, {"lr": 0.1, "weight_decay": 1e-4}),
+    "AdaptDectectionMomentumLR": (AdaptDectectionMomentumLR, torch.optim.SGD, {"lr": 0.1, "momentum": 0.9, "weight_decay": 1e-4}),
+    "AdaptDectectionAdamLR": (AdaptDectectionAdamLR, torch.optim.Adam, {"lr": 0.001, "weight_decay": 1e-4}),
+    "LayerwiseAdaptDectectionLR": (LayerwiseAdaptDectectionLR, torch.optim.SGD, {"lr": 0.1, "weight_decay": 1e-4}),
+}
+
+
+# per-step work of every scheduler (step() per batch, buffer_step() for the buffered ones) next to
+# the optimizer.step() it rides on: wall time, peak memory, allocations and the state it holds.
+# LayerwiseAdaptDectectionLR takes one group (with the layers when layerwise) and does its per step
+# work in a step pre hook, its optimizer_step includes it
+def bench_schedulers(layerwise=False, steps=10, device="cpu", num_classes=100):
+    model = ResNet(3, 32, num_classes).to(device)
+    fill_grads(model)
+    res = {}
+    for name, (cls, optimizer_cls, kwargs) in SCHEDULERS.items():
+        single_group = cls is LayerwiseAdaptDectectionLR
+        params = model.parameters_layerwise() if layerwise and not single_group else model.parameters()
+        optimizer = optimizer_cls(params, **kwargs)
+        # the optimizer state (momentum/adam buffers) the schedulers read
+        optimizer.step()
+        if single_group:
+            scheduler = cls(optimizer, model.parameters_layerwise() if layerwise else None)
+        else:
+            scheduler = cls(optimizer)
+        fn = scheduler.buffer_step if scheduler_step_mode(scheduler) == BUFFERED else scheduler.step
+        res[name] = {"num_groups": len(optimizer.param_groups),
+                     "optimizer_step": time_fn(optimizer.step, steps, device),
+                     "scheduler_step": time_fn(fn, steps, device),
+                     **memory_stats(fn, device),
+                     "scheduler_bytes": scheduler.memory_footprint()["total"] if hasattr(scheduler, "memory_footprint") else 0}
+    return res
+
+
+# images/sec of the train loop of every trainer variant on synthetic cifar shaped data, the last of
+# epochs is measured so the first absorbs the warm up
+def bench_trainers(epochs=2, device="cpu", num_image=None):
+    from trainers import Trainer, HDTrainer, ADSTrainer
+    variants = {
+        "Trainer+BlankLR": (Trainer, BlankLR, {}, {}),
+        "HDTrainer+HyperGradientLR": (HDTrainer, HyperGradientLR, {}, {}),
+        "ADSTrainer+AdaptDectectionLR": (ADSTrainer, AdaptDectectionLR, {}, {}),
+        "ADSTrainer+AdaptDectectionLR(sync_free)": (ADSTrainer, AdaptDectectionLR, {}, {"sync_free": True}),
+        "ADSTrainer+AdaptDectectionLR(channels_last)": (ADSTrainer, AdaptDectectionLR, {"channels_last": True}, {}),
+        "ADSTrainer+AdaptDectectionLR(bf16)": (ADSTrainer, AdaptDectectionLR, {"amp": BF16}, {}),
+    }
+    res = {}
+    for name, (trainer_cls, scheduler_cls, trainer_kwargs, scheduler_kwargs) in variants.items():
+        torch.manual_seed(0)
+        trainer = trainer_cls(SYNTHETIC, device=device, prefetch=False, synthetic_images=num_image, **trainer_kwargs)
+        optimizer = torch.optim.SGD(trainer.model.parameters_layerwise(), lr=0.1, weight_decay=1e-4)
+        trainer.set_optimizer(optimizer)
+        trainer.set_scheduler(scheduler_cls(optimizer, **scheduler_kwargs))
+        records = []
+        trainer.register_epoch_hook(lambda trainer, epoch, record: records.append(record))
+        trainer.train(epochs=epochs)
+        res[name] = {"images_per_sec": records[-1]["images_per_sec"], "num_image": trainer.num_image,
+                     "batch_size": NAME2BATCHSIZE[SYNTHETIC]}
+    return res
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True).stdout.strip()
+    except OSError:
+        commit = None
+    return {"commit": commit, "torch": torch.__version__, "python": platform.python_version(),
+            "machine": platform.machine(), "num_threads": torch.get_num_threads()}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--device", default=default_device())
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--storage", action="store_true", help="accuracy vs memory of the accumulator storage modes")
+    parser.add_argument("--adam", action="store_true", help="time and peak memory of the adam direction")
+    parser.add_argument("--memory-format", action="store_true", help="train step throughput, nchw vs channels_last")
+    parser.add_argument("--estimators", action="store_true", help="variance and cost of the sampled hypergradient estimators")
+    parser.add_argument("--layerwise-lr", action="store_true", help="layer wise adapt detection, param groups vs one group")
+    parser.add_argument("--suite", action="store_true", help="every scheduler and trainer variant, written to --out")
+    parser.add_argument("--out", default="benchmark.json")
+    parser.add_argument("--images", type=int, default=NUMIMAGE[SYNTHETIC], help="synthetic train images per trainer epoch")
+    args = parser.parse_args()
+    if args.suite:
+        res = {"environment": environment(), "device": args.device, "steps": args.steps}
+        for layerwise in [False, True]:
+            wise = "layer" if layerwise else "model"
+            res[f"schedulers_{wise}wise"] = bench_schedulers(layerwise, args.steps, args.device)
+            for name, item in res[f"schedulers_{wise}wise"].items():
+                print(f"{wise} wise {name}->step:{round(item['scheduler_step']*1e3, 3)}ms "
+                      f"(optimizer {round(item['optimizer_step']*1e3, 3)}ms), peak:{round(item['peak_bytes']/2**20, 2)}MiB, "
+                      f"allocations:{item['allocations']}, state:{round(item['scheduler_bytes']/2**20, 2)}MiB")
+        res["trainers"] = bench_trainers(device=args.device, num_image=args.images)
+        for name, item in res["trainers"].items():
+            print(f"{name}->images/s:{round(item['images_per_sec'], 2)}")
+        with open(args.out, "w") as f:
+            json.dump(res, f, indent=2)
+        exit()
+    if args.layerwise_lr:
+        res = bench_layerwise_lr(args.steps, args.device)
+        for name in ["modelwise", "layerwise_groups", "layerwise_vector"]:
+            print(f"{name} ({res[name]['num_groups']} groups)->step:{round(res[name]['step']*1e3, 3)}ms")
+        exit()
+    if args.memory_format:
+        res = bench_memory_format(args.device)
+        for name in ["nchw", "channels_last"]:
+            print(f"{name}->images/s:{round(res[name]['images_per_sec'], 2)}, step:{round(res[name]['step']*1e3, 3)}ms, "
+                  f"buffer_step:{round(res[name]['buffer_step']*1e3, 3)}ms, matching_strides:{res[name]['matching_strides']}")
+        exit()
+    for layerwise in [False, True]:
+        wise = "layer" if layerwise else "model"
+        if args.storage:
+            res = bench_storage(layerwise, device=args.device)
+            for name in res:
+                if isinstance(res[name], dict):
+                    print(f"{wise} wise {name}->"
+                          f"memory:{round(res[name]['bytes']/2**20, 2)}MiB, rel_error:{res[name]['rel_error']:.2e}")
+            continue
+        if args.estimators:
+            res = bench_estimators(layerwise, device=args.device)
+            for name in res:
+                if isinstance(res[name], dict):
+                    print(f"{wise} wise {name}->time:{round(res[name]['time']*1e3, 3)}ms, memory:{round(res[name]['bytes']/2**20, 2)}MiB, "
+                          f"rel_variance:{res[name]['rel_variance']:.2e}, rel_bias:{res[name]['rel_bias']:.2e}")
+            continue
+        if args.adam:
+            res = bench_adam_direction(layerwise, device=args.device)
+            for name in res:
+                if isinstance(res[name], dict):
+                    print(f"{wise} wise {name}->"
+                          f"time:{round(res[name]['time']*1e3, 3)}ms, peak:{round(res[name]['peak_bytes']/2**20, 2)}MiB")
+            print(f"{wise} wise optimizer.step->time:{round(res['optimizer_step']*1e3, 3)}ms, "
+                  f"identical:{res['AdaptDectectionAdamLR_identical'] and res['HyperGradientAdamLR_identical']}")
+            continue
+        res = bench_buffer_step(layerwise, args.steps, args.device)
+        print(f"{wise} wise ({res['num_groups']} groups)->"
+              f"step:{round(res['optimizer_step']*1e3, 3)}ms, "
+              f"loop:{round(res['buffer_step_loop']*1e3, 3)}ms (x{round(res['overhead_loop'], 2)}), "
+              f"foreach:{round(res['buffer_step_foreach']*1e3, 3)}ms (x{round(res['overhead_foreach'], 2)}), "
+              f"identical:{res['identical']}, lr_grad_rel_error:{res['lr_grad_rel_error']:.2e}, scheduler:{round(res['scheduler_bytes']/2**20, 2)}MiB")
+    pass
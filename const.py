@@ -1,5 +1,14 @@
-# device
-DEVICE = "cuda:0"
+# when the trainer steps a scheduler: once per epoch, after every batch, or buffer_step after every
+# batch plus step once per epoch
+PER_EPOCH = "per_epoch"
+PER_BATCH = "per_batch"
+BUFFERED = "buffered"
+# mixed precision
+FP16 = "fp16"
+BF16 = "bf16"
+# sampled hypergradient estimators: a random subset of every param's coordinates, or of the params
+COORDINATE = "coordinate"
+PARAM = "param"
 # datasets
 CIFAR10 = "cifar-10-batches-py"
 CIFAR100 = "cifar-100-python"
@@ -9,13 +18,18 @@ IRIS = "iris"
 WINE = "wine"
 CAR = "car"
 AGARICUS = "agaricus_lepiota"
+# random cifar shaped images, for benchmarks and smoke runs without downloads
+SYNTHETIC = "synthetic"
+# encoded train/test splits of the tabular datasets
+TABULARCACHE = "data/cache/"
 
 DATASETS = [CIFAR10, CIFAR100, MNIST, SVHN]
 NUMIMAGE = {
     MNIST: 60000,
     SVHN: 73257,
     CIFAR10: 50000,
-    CIFAR100: 50000
+    CIFAR100: 50000,
+    SYNTHETIC: 256,
 }
 CIFAR10MEAN = (0.4914, 0.4822, 0.4465)
 CIFAR10STD = (0.2470, 0.2435, 0.2616)
@@ -30,6 +44,8 @@ SVHNSTD = (0.19803012907505035, 0.2010156363248825, 0.19703614711761475)
 # """hyper-params"""
 P_MOMENTUM = 0.9
 BATCHSIZE = 64
+# test loaders, evaluation keeps no activations so it affords much larger batches
+EVALBATCHSIZE = 1024
 EPOCHS = 200
 EXPANDTIMES = 20
 NAME2BATCHSIZE = {
@@ -37,6 +53,24 @@ NAME2BATCHSIZE = {
     CIFAR100: 32,
     MNIST: 128,
     SVHN: 64,
+    SYNTHETIC: 32,
+    IRIS: 16,
+    WINE: 16,
+    CAR: 64,
+    AGARICUS: 256,
+}
+# loader worker processes (train and test), pinned batches and side stream prefetching per dataset
+NAME2NUMWORKERS = {
+    CIFAR10: 4,
+    CIFAR100: 4,
+    MNIST: 4,
+    SVHN: 4,
+}
+NAME2PREFETCH = {
+    CIFAR10: True,
+    CIFAR100: True,
+    MNIST: True,
+    SVHN: True,
 }
 # cnn model name
 RESNET = "ResNet"
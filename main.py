@@ -1,4 +1,4 @@
-from trainers import Trainer, HDTrainer, ADSTrainer
+from trainers import Trainer, HDTrainer, ADSTrainer, TabularTrainer
 from const import *
 from torch.optim import SGD, Adam, Adagrad, RMSprop, Adadelta
 from model.blank import BlankLR
@@ -49,12 +49,23 @@ if __name__ == "__main__":
     # trainer.set_optimizer(optimizer)
     # trainer.set_scheduler(scheduler)
     # trainer.train()
+    # '''tabular ads'''
+    # trainer = TabularTrainer(IRIS)
+    # trainer = TabularTrainer(IRIS, full_batch=True)
+    # optimizer = SGD(trainer.model.parameters_layerwise(), lr=0.1, weight_decay=1e-4)
+    # scheduler = AdaptDectectionLR(optimizer, sync_free=True)
+    # trainer.set_optimizer(optimizer)
+    # trainer.set_scheduler(scheduler)
+    # trainer.train()
     # '''layer wise ads'''
     trainer = ADSTrainer(CIFAR100)
+    # trainer = ADSTrainer(CIFAR100, compile=True)
+    # trainer = ADSTrainer(CIFAR100, distributed=True)  # torchrun --nproc_per_node=N main.py
     optimizer = SGD(trainer.model.parameters_layerwise(), lr=0.1, weight_decay=1e-4)
     # optimizer = SGD(trainer.model.parameters_layerwise(), lr=0.1, momentum=0.9, weight_decay=1e-4)
     # optimizer = Adam(trainer.model.parameters_layerwise(), lr=0.001, weight_decay=1e-4)
     scheduler = AdaptDectectionLR(optimizer,)
+    # scheduler = AdaptDectectionLR(optimizer, sync_free=True)
     # scheduler = AdaptDectectionMomentumLR(optimizer,)
     # scheduler = AdaptDectectionAdamLR(optimizer,)
     trainer.set_optimizer(optimizer)
@@ -1,82 +1,208 @@
-from torch.optim.optimizer import Optimizer
-from torch.optim.lr_scheduler import _LRScheduler
+from const import BUFFERED, COORDINATE
+from model.base import BaseAdaptiveLR, HyperBuffer, adam_direction, flat_buffer, foreach_adam_directions, numel_chunks, param_positions
 import torch
-import torch.nn.functional as F
-import math
-
-
-class AdaptDectectionLR(_LRScheduler):
-    def __init__(self, optimizer: torch.optim.SGD, meta_lr=2e-4, loss_decay=0.99, last_epoch: int = -1, verbose=False) -> None:
-        self.last_lr_grad = [0] * len(optimizer.param_groups)
-        self.accumulated_param_grad = []
-        for group in optimizer.param_groups:
-            tmp_accumulated_param_grad = []
-            for param in group["params"]:
-                tmp_accumulated_param_grad.append(torch.zeros(
-                    param.size(), device=param.device))
-            self.accumulated_param_grad.append(tmp_accumulated_param_grad)
+
+
+class AdaptDectectionLR(BaseAdaptiveLR):
+    # foreach (opt-in, exact fp32 accumulators only) runs buffer_step as a few multi-tensor and flat
+    # kernels instead of a loop over the params. its accumulator matches the loop bit for bit, but it
+    # sums the dots in another order, so its lr grads and lrs match the loop only up to float
+    # rounding (benchmark.py without flags reports the difference). the default loop keeps the
+    # original numerics
+    step_mode = BUFFERED
+
+    def __init__(self, optimizer: torch.optim.SGD, meta_lr=2e-4, loss_decay=0.99, last_epoch: int = -1, verbose=False, foreach=False, sync_free=False, buffer_dtype=None, sketch_dim=None, sample_rate=None, sample_mode=COORDINATE, resample_interval=1, distributed=None, foreach_chunk=2**22) -> None:
+        # the params laid out segment by segment, each segment's dots are then one contiguous run
+        segments, num_segments = self._segments(optimizer.param_groups)
+        order = sorted(param_positions(optimizer.param_groups), key=lambda position: segments[position[0]][position[1]])
+        self.accumulated_param_grad = HyperBuffer(optimizer.param_groups, buffer_dtype, sketch_dim, sample_rate=sample_rate, sample_mode=sample_mode, resample_interval=resample_interval, order=order)
         self.meta_lr = meta_lr
         self.max_lr = 0.2
         self.min_lr = 0.001
+        self.init_foreach(optimizer, foreach, foreach_chunk)
+        self.foreach = self.foreach and self.accumulated_param_grad.exact
+        if self.foreach:
+            self._init_flat_grad(optimizer.param_groups, segments, num_segments, order)
         # self.loss_decay = loss_decay
-        super(AdaptDectectionLR, self).__init__(optimizer, last_epoch, verbose)
+        super(AdaptDectectionLR, self).__init__(optimizer, last_epoch, verbose, sync_free, distributed)
         return
 
     def get_lr(self) -> float:
-        lrs = []
-        for lr_idx, group in enumerate(self.optimizer.param_groups):
-            tmp_lr = group['lr']+self.meta_lr*self.last_lr_grad[lr_idx]
-            if tmp_lr > self.max_lr:
-                lrs.append(self.max_lr)
-            elif tmp_lr < self.min_lr:
-                lrs.append(self.min_lr)
-            else:
-                lrs.append(tmp_lr)
-        for lr_idx, group in enumerate(self.optimizer.param_groups):
-            self.last_lr_grad[lr_idx] = 0
-            for i, param in enumerate(group["params"]):
-                self.accumulated_param_grad[lr_idx][i] = torch.zeros(param.size(), device=param.device)
+        lrs = self.clamp_lr(self.last_lr_grad)
+        self.reset_lr_grad()
+        self.accumulated_param_grad.zero_()
+        self.accumulated_param_grad.advance()
         return list(lrs)
 
     def buffer_step(self, num_batch=1500) -> None:
+        if self.foreach:
+            return self._foreach_buffer_step(num_batch)
         for lr_idx, group in enumerate(self.optimizer.param_groups):
             grad = 0
             for i, param in enumerate(group["params"]):
                 if param.grad != None:
-                    grad += torch.sum(torch.mul(self.accumulated_param_grad[lr_idx][i], param.grad.data))
-                    self.accumulated_param_grad[lr_idx][i] += param.grad.data.clone()
+                    grad += self.accumulated_param_grad.dot(lr_idx, i, param.grad.data)
+                    self.accumulated_param_grad.add_(lr_idx, i, param.grad.data)
             self.last_lr_grad[lr_idx] += grad/num_batch
         return
 
+    def _segments(self, param_groups):
+        # the segment of every param (nested like param_groups) and the number of segments, the
+        # foreach path sums the dots per segment. one per group, every group has its lr
+        return [[lr_idx]*len(group["params"]) for lr_idx, group in enumerate(param_groups)], len(param_groups)
+
+    def _init_flat_grad(self, param_groups, segments, num_segments, order) -> None:
+        # a grad scratch laid out like the accumulator (params in order, their segments ascending),
+        # allocated once. the products are taken in chunks of at most foreach_chunk elements (or one
+        # param), each with the number of its elements in every segment, on device for segment_reduce
+        self.flat_grad, self.grad_views = flat_buffer(param_groups, order=order)
+        params = [param_groups[lr_idx]["params"][i] for lr_idx, i in order]
+        device = self.flat_grad.device
+        self.flat_chunks = []
+        start = 0
+        for chunk_positions, chunk_params in numel_chunks(order, params, self.foreach_chunk):
+            lengths = [0]*num_segments
+            for (lr_idx, i), param in zip(chunk_positions, chunk_params):
+                lengths[segments[lr_idx][i]] += param.numel()
+            self.flat_chunks.append((start, start+sum(lengths), torch.tensor(lengths, device=device)))
+            start += sum(lengths)
+        self.flat_product = torch.empty(max(end-start for start, end, _ in self.flat_chunks), device=device)
+        self.grad_positions = None
+        return
+
+    def _foreach_accumulate(self, positions, grads):
+        # the dots of grads (of the params at positions) with the accumulator summed per segment, then
+        # adds the grads to it: a multi-tensor copy into the scratch, a mul and a segment_reduce per
+        # chunk and one flat add, without allocations of model size. segment_reduce sums in a fixed
+        # order and without atomics (index_add_ adds atomically on cuda, in no fixed order), so the
+        # result is deterministic, but it sums in another order than the per param loop: the
+        # accumulator matches the loop bit for bit, the lr grads only up to float rounding
+        if positions != self.grad_positions:
+            # params without a grad keep zeros in the scratch and add nothing
+            self.flat_grad.zero_()
+            self.grad_positions = positions
+        torch._foreach_copy_([self.grad_views[lr_idx][i] for lr_idx, i in positions], grads)
+        accumulator = self.accumulated_param_grad.flat
+        dots = None
+        for start, end, lengths in self.flat_chunks:
+            product = torch.mul(accumulator[start:end], self.flat_grad[start:end], out=self.flat_product[:end-start])
+            # unsafe skips the checks of the lengths, which read them back to the host and hold by
+            # construction
+            chunk_dots = torch.segment_reduce(product, "sum", lengths=lengths, unsafe=True, initial=0)
+            dots = chunk_dots if dots is None else dots.add_(chunk_dots)
+        accumulator.add_(self.flat_grad)
+        return dots
+
+    def _foreach_buffer_step(self, num_batch) -> None:
+        positions, grads = [], []
+        for lr_idx, group in enumerate(self.optimizer.param_groups):
+            for i, param in enumerate(group["params"]):
+                if param.grad is not None:
+                    positions.append((lr_idx, i))
+                    grads.append(param.grad.data)
+        if len(grads) == 0:
+            return
+        group_grads = self._foreach_accumulate(positions, grads)/num_batch
+        if self.sync_free:
+            self.last_lr_grad += group_grads
+        else:
+            for lr_idx in range(len(self.optimizer.param_groups)):
+                self.last_lr_grad[lr_idx] += group_grads[lr_idx]
+        return
+
+
+class LayerwiseAdaptDectectionLR(AdaptDectectionLR):
+    # AdaptDectectionLR with one lr per layer on an optimizer with a single param group, so that
+    # torch.optim and the scheduler each handle all params in one multi-tensor pass. layers (e.g.
+    # model.parameters_layerwise(), default one layer per param) are only known to the scheduler,
+    # their lrs live in the device vector layer_lr and the group lr stays fixed as the reference.
+    # a step pre hook accumulates the raw grads and their dots with the accumulator (summed per
+    # layer by the foreach path, the accumulator lays the params out layer by layer), then scales
+    # every grad by its layer's lr/group lr (scale_param_grads), so the optimizer's step is the
+    # layerwise sgd step. the ratios are host floats, read back once per lr update, so the scaling
+    # is one multi-tensor launch. plain sgd only, adam would cancel the scaling and momentum buffers
+    # would hold directions scaled by older lrs.
+    def __init__(self, optimizer: torch.optim.SGD, layers=None, meta_lr=2e-4, last_epoch: int = -1, verbose=False, distributed=None) -> None:
+        if len(optimizer.param_groups) != 1:
+            raise ValueError("LayerwiseAdaptDectectionLR takes an optimizer with a single param group")
+        group = optimizer.param_groups[0]
+        if not isinstance(optimizer, torch.optim.SGD) or group["momentum"] != 0 or group["nesterov"]:
+            raise ValueError("LayerwiseAdaptDectectionLR takes plain sgd, without momentum or nesterov")
+        params = group["params"]
+        if layers is None:
+            layers = [[param] for param in params]
+        layers = [layer["params"] if isinstance(layer, dict) else layer for layer in layers]
+        owner = {param: layer_idx for layer_idx, layer in enumerate(layers) for param in layer}
+        if any(param not in owner for param in params):
+            raise ValueError("every param of the optimizer needs a layer")
+        device = params[0].device
+        self.param_layer = [owner[param] for param in params]
+        self.num_layers = len(layers)
+        self.layer_lr = torch.full((len(layers),), float(group["lr"]), device=device)
+        # layer_lr/group lr on the host, for the grad scaling
+        self.layer_ratio = [1.0]*len(layers)
+        self.layer_lr_grad = torch.zeros(len(layers), device=device)
+        # dots of the steps since the last buffer_step, normalized by num_batch there
+        self.step_lr_grad = torch.zeros(len(layers), device=device)
+        super(LayerwiseAdaptDectectionLR, self).__init__(optimizer, meta_lr, last_epoch=last_epoch, verbose=verbose, foreach=True,
+                                                         sync_free=True, distributed=distributed)
+        self.init_grad_scaling(optimizer)
+        return
+
+    def get_lr(self) -> float:
+        lr_grads = self.layer_lr_grad
+        if self.distributed:
+            lr_grads = self.all_reduce_lr_grads(lr_grads)
+        self.applied_lr_grad = lr_grads.clone()
+        torch.clamp(self.layer_lr+self.meta_lr*lr_grads, self.min_lr, self.max_lr, out=self.layer_lr)
+        # the one read back of an lr update
+        group = self.optimizer.param_groups[0]
+        self.layer_ratio = (self.layer_lr/group["lr"]).tolist()
+        self.layer_lr_grad.zero_()
+        self.accumulated_param_grad.zero_()
+        return [group["lr"] for group in self.optimizer.param_groups]
+
+    def _segments(self, param_groups):
+        return [self.param_layer], self.num_layers
+
+    @torch.no_grad()
+    def scale_grads(self, optimizer, args, kwargs) -> None:
+        group = self.optimizer.param_groups[0]
+        indices = [i for i, param in enumerate(group["params"]) if param.grad is not None]
+        if len(indices) == 0:
+            return
+        params = [group["params"][i] for i in indices]
+        grads = [param.grad.data for param in params]
+        self.step_lr_grad += self._foreach_accumulate([(0, i) for i in indices], grads)
+        self.scale_param_grads(0, params, [self.layer_ratio[self.param_layer[i]] for i in indices])
+        return
+
+    def buffer_step(self, num_batch=1500) -> None:
+        self.layer_lr_grad.add_(self.step_lr_grad, alpha=1/num_batch)
+        self.step_lr_grad.zero_()
+        return
+
+    def read_lr(self) -> list:
+        return self.layer_lr.tolist()
 
-class AdaptDectectionMomentumLR(_LRScheduler):
-    def __init__(self, optimizer: torch.optim.SGD, meta_lr=5e-5, loss_decay=0.99, last_epoch: int = -1, verbose=False) -> None:
-        self.last_lr_grad = [0] * len(optimizer.param_groups)
-        self.accumulated_momentum_buffer = []
-        for param in optimizer.param_groups[0]["params"]:
-            self.accumulated_momentum_buffer.append(torch.zeros(
-                param.size(), device=param.device))
+
+class AdaptDectectionMomentumLR(BaseAdaptiveLR):
+    step_mode = BUFFERED
+
+    def __init__(self, optimizer: torch.optim.SGD, meta_lr=5e-5, loss_decay=0.99, last_epoch: int = -1, verbose=False, sync_free=False, buffer_dtype=None, sketch_dim=None, sample_rate=None, sample_mode=COORDINATE, resample_interval=1, distributed=None) -> None:
+        self.accumulated_momentum_buffer = HyperBuffer(optimizer.param_groups, buffer_dtype, sketch_dim, sample_rate=sample_rate, sample_mode=sample_mode, resample_interval=resample_interval)
         self.meta_lr = meta_lr
         self.max_lr = 0.2
         self.min_lr = 0.001
         self.loss_decay = loss_decay
-        super(AdaptDectectionMomentumLR, self).__init__(optimizer, last_epoch, verbose)
+        super(AdaptDectectionMomentumLR, self).__init__(optimizer, last_epoch, verbose, sync_free, distributed)
         return
 
     def get_lr(self) -> float:
-        lrs = []
-        for lr_idx, group in enumerate(self.optimizer.param_groups):
-            tmp_lr = group['lr']+self.meta_lr*self.last_lr_grad[lr_idx]
-            if tmp_lr > self.max_lr:
-                lrs.append(self.max_lr)
-            elif tmp_lr < self.min_lr:
-                lrs.append(self.min_lr)
-            else:
-                lrs.append(tmp_lr)
-        for lr_idx, group in enumerate(self.optimizer.param_groups):
-            self.last_lr_grad[lr_idx] = 0
-            for i, param in enumerate(group["params"]):
-                self.accumulated_momentum_buffer[i] = torch.zeros(param.size(), device=param.device)
+        lrs = self.clamp_lr(self.last_lr_grad)
+        self.reset_lr_grad()
+        self.accumulated_momentum_buffer.zero_()
+        self.accumulated_momentum_buffer.advance()
         return list(lrs)
 
     def buffer_step(self, num_batch=1500) -> None:
@@ -84,66 +210,63 @@ class AdaptDectectionMomentumLR(_LRScheduler):
             grad = 0
             for i, param in enumerate(group["params"]):
                 if param.grad != None:
-                    grad += torch.sum(torch.mul(self.accumulated_momentum_buffer[i], param.grad.data))
-                    self.accumulated_momentum_buffer[i] += self.optimizer.state[param]["momentum_buffer"].data.clone()
+                    grad += self.accumulated_momentum_buffer.dot(lr_idx, i, param.grad.data)
+                    self.accumulated_momentum_buffer.add_(lr_idx, i, self.optimizer.state[param]["momentum_buffer"].data)
             # self.last_lr_grad[lr_idx] = self.loss_decay*self.last_lr_grad[lr_idx]+(1-self.loss_decay)/(1-self.loss_decay**num_batch)*grad
             self.last_lr_grad[lr_idx] += grad/num_batch
         return
 
 
-class AdaptDectectionAdamLR(_LRScheduler):
-    def __init__(self, optimizer: torch.optim.SGD, meta_lr=1e-6, loss_decay=0.99, last_epoch: int = -1, verbose=False) -> None:
-        self.last_lr_grad = [0] * len(optimizer.param_groups)
-        self.accumulated_adam_buffer = []
-        for param in optimizer.param_groups[0]["params"]:
-            self.accumulated_adam_buffer.append(torch.zeros(
-                param.size(), device=param.device))
+class AdaptDectectionAdamLR(BaseAdaptiveLR):
+    step_mode = BUFFERED
+
+    def __init__(self, optimizer: torch.optim.SGD, meta_lr=1e-6, loss_decay=0.99, last_epoch: int = -1, verbose=False, sync_free=False, buffer_dtype=None, sketch_dim=None, sample_rate=None, sample_mode=COORDINATE, resample_interval=1, distributed=None, foreach=None, foreach_chunk=2**22) -> None:
+        self.accumulated_adam_buffer = HyperBuffer(optimizer.param_groups, buffer_dtype, sketch_dim, sample_rate=sample_rate, sample_mode=sample_mode, resample_interval=resample_interval)
         self.meta_lr = meta_lr
         self.max_lr = 0.002
         self.min_lr = 0.00001
         self.loss_decay = loss_decay
-        super(AdaptDectectionAdamLR, self).__init__(optimizer, last_epoch, verbose)
+        self.init_foreach(optimizer, foreach, foreach_chunk)
+        super(AdaptDectectionAdamLR, self).__init__(optimizer, last_epoch, verbose, sync_free, distributed)
         return
 
     def get_lr(self) -> float:
-        lrs = []
-        for lr_idx, group in enumerate(self.optimizer.param_groups):
-            tmp_lr = group['lr']+self.meta_lr*self.last_lr_grad[lr_idx]
-            if tmp_lr > self.max_lr:
-                lrs.append(self.max_lr)
-            elif tmp_lr < self.min_lr:
-                lrs.append(self.min_lr)
-            else:
-                lrs.append(tmp_lr)
-        for lr_idx, group in enumerate(self.optimizer.param_groups):
-            self.last_lr_grad[lr_idx] = 0
-            for i, param in enumerate(group["params"]):
-                self.accumulated_adam_buffer[i] = torch.zeros(param.size(), device=param.device)
+        lrs = self.clamp_lr(self.last_lr_grad)
+        self.reset_lr_grad()
+        self.accumulated_adam_buffer.zero_()
+        self.accumulated_adam_buffer.advance()
         return list(lrs)
 
     def buffer_step(self, num_batch=1500) -> None:
+        if self.foreach:
+            return self._foreach_buffer_step(num_batch)
         for lr_idx, group in enumerate(self.optimizer.param_groups):
             lr_grad = 0
             for i, param in enumerate(group["params"]):
                 if param.grad != None:
-                    lr_grad += torch.sum(torch.mul(self.accumulated_adam_buffer[i], param.grad.data))
-                    grad = param.grad.data
-                    exp_avg = self.optimizer.state[param]["exp_avg"].data
-                    exp_avg_sq = self.optimizer.state[param]["exp_avg_sq"].data
-                    step = self.optimizer.state[param]["step"]
-                    beta1, beta2 = group['betas']
-                    weight_decay = group['weight_decay']
-                    eps = group["eps"]
-
-                    bias_correction1 = 1 - beta1 ** step
-                    bias_correction2 = 1 - beta2 ** step
-
-                    if weight_decay != 0:
-                        grad = grad.add(param, alpha=weight_decay)
-
-                    numer = exp_avg.mul(beta1).add(grad, alpha=1 - beta1).div(bias_correction1)
-                    denom = (exp_avg_sq.mul(beta2).addcmul(grad, grad, value=1 - beta2).sqrt() / math.sqrt(bias_correction2)).add(eps)
-                    self.accumulated_adam_buffer[i] += torch.div(numer, denom).data.clone()
+                    lr_grad += self.accumulated_adam_buffer.dot(lr_idx, i, param.grad.data)
+                    if self.accumulated_adam_buffer.sampled(lr_idx, i):
+                        self.accumulated_adam_buffer.add_(lr_idx, i, adam_direction(self.optimizer, group, param))
+                    else:
+                        self.accumulated_adam_buffer.add_(lr_idx, i, None)
             # self.last_lr_grad[lr_idx] = self.loss_decay*self.last_lr_grad[lr_idx]+(1-self.loss_decay)/(1-self.loss_decay**num_batch)*lr_grad
             self.last_lr_grad[lr_idx] += lr_grad/num_batch
         return
+
+    def _foreach_buffer_step(self, num_batch) -> None:
+        for lr_idx, group in enumerate(self.optimizer.param_groups):
+            lr_grad = 0
+            indices = []
+            for i, param in enumerate(group["params"]):
+                if param.grad is not None:
+                    lr_grad += self.accumulated_adam_buffer.dot(lr_idx, i, param.grad.data)
+                    if self.accumulated_adam_buffer.sampled(lr_idx, i):
+                        indices.append(i)
+                    else:
+                        self.accumulated_adam_buffer.add_(lr_idx, i, None)
+            params = [group["params"][i] for i in indices]
+            for chunk_indices, chunk_params in numel_chunks(indices, params, self.foreach_chunk):
+                directions = foreach_adam_directions(self.optimizer, group, chunk_params)
+                self.accumulated_adam_buffer.foreach_add_(lr_idx, chunk_indices, directions)
+            self.last_lr_grad[lr_idx] += lr_grad/num_batch
+        return
@@ -0,0 +1,485 @@
+from torch.optim.lr_scheduler import _LRScheduler
+import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+import math
+from const import COORDINATE, PARAM
+
+
+def param_view(flat, offset, param):
+    # a view shaped like param with param's strides when those are dense (e.g. channels_last), so
+    # element-wise ops between the two walk memory in the same order
+    if is_dense(param):
+        return flat.as_strided(param.size(), param.stride(), offset)
+    return flat[offset:offset+param.numel()].view_as(param)
+
+
+def is_dense(tensor):
+    # strides of a permuted contiguous tensor, no gaps and no overlap
+    expected = 1
+    for dim in sorted(range(tensor.dim()), key=lambda dim: (tensor.stride(dim), tensor.size(dim))):
+        if tensor.size(dim) != 1 and tensor.stride(dim) != expected:
+            return False
+        expected *= tensor.size(dim)
+    return True
+
+
+def flat_buffer(param_groups, dtype=None, sketch_dim=None, sample_rate=None, order=None):
+    # one zeroed allocation for all params plus per-param views into it, nested like param_groups.
+    # with sketch_dim every param only gets a 1-d view of at most sketch_dim elements, with
+    # sample_rate one of sample_size(param, sample_rate) elements. order lists the (group, param)
+    # positions in the order they are laid out in the flat tensor, default that of param_groups
+    if order is None:
+        order = param_positions(param_groups)
+    params = [param_groups[lr_idx]["params"][i] for lr_idx, i in order]
+    sizes = [compact_size(param, sketch_dim, sample_rate) for param in params]
+    flat = torch.zeros(sum(sizes), dtype=dtype, device=params[0].device)
+    views = [[None]*len(group["params"]) for group in param_groups]
+    offset = 0
+    for (lr_idx, i), param, size in zip(order, params, sizes):
+        if sketch_dim or sample_rate:
+            views[lr_idx][i] = flat[offset:offset+size]
+        else:
+            views[lr_idx][i] = param_view(flat, offset, param)
+        offset += size
+    return flat, views
+
+
+def param_positions(param_groups):
+    return [(lr_idx, i) for lr_idx, group in enumerate(param_groups) for i in range(len(group["params"]))]
+
+
+def compact_size(param, sketch_dim=None, sample_rate=None):
+    if sketch_dim:
+        return min(sketch_dim, param.numel())
+    if sample_rate:
+        return sample_size(param, sample_rate)
+    return param.numel()
+
+
+def sample_size(param, sample_rate):
+    return max(1, math.ceil(sample_rate*param.numel()))
+
+
+class HyperBuffer():
+    # per-param state of a scheduler (accumulated grads, last momentum/adam directions). by default
+    # exact: fp32, every coordinate of every param.
+    # dtype (opt-in) stores it in bf16/fp16, the dots are still reduced in fp32. every write rounds
+    # to dtype, so the error of a summed buffer grows with the steps it sums (bf16 on the ResNet:
+    # 6e-4 relative hypergradient error after 5 steps, 4.5e-3 after a cifar10 epoch, see
+    # benchmark.py --storage).
+    # sketch_dim keeps a fixed size count sketch of each param instead. its dot with the sketched
+    # grad is an unbiased estimate of the exact one, exact for params of at most sketch_dim elements.
+    # sample_rate keeps a random sample instead, redrawn every resample_interval advance() calls.
+    # COORDINATE stores sample_rate of each param's coordinates (drawn with replacement) and scales
+    # their dot by numel/samples, PARAM keeps every param with probability sample_rate and scales its
+    # dot by 1/sample_rate. both are unbiased and cost O(samples) per dot, not O(numel). PARAM still
+    # allocates the full size buffer, as any param may be drawn, so it saves compute only.
+    # order lays the params out in the flat tensor, as in flat_buffer.
+    def __init__(self, param_groups, dtype=None, sketch_dim=None, seed=0, sample_rate=None, sample_mode=COORDINATE, resample_interval=1, order=None) -> None:
+        if sketch_dim and sample_rate:
+            raise ValueError("sketch_dim and sample_rate are exclusive")
+        if sample_mode not in (COORDINATE, PARAM):
+            raise ValueError(f"unknown sample_mode {sample_mode}")
+        self.dtype = dtype if dtype else torch.float32
+        self.sketch_dim = sketch_dim
+        self.seed = seed
+        self.sample_rate = sample_rate
+        self.sample_mode = sample_mode
+        self.resample_interval = resample_interval
+        coordinates = sample_rate if sample_mode == COORDINATE else None
+        self.flat, self.views = flat_buffer(param_groups, torch.float32 if sketch_dim else self.dtype, sketch_dim, coordinates, order)
+        if sketch_dim or sample_rate:
+            self.generator = torch.Generator(device=self.flat.device)
+            # index of each group's first param, so that every param gets its own signs
+            self.first_index = [0]
+            for group in param_groups[:-1]:
+                self.first_index.append(self.first_index[-1]+len(group["params"]))
+        if sample_rate:
+            # the sample the stored values belong to (read by dot) and the one the next write uses.
+            # a write moves its param to the new sample, so a resample never pairs values of one
+            # sample with coordinates of another
+            self.numels = [[param.numel() for param in group["params"]] for group in param_groups]
+            self.num_advance = 0
+            self.generator.manual_seed(seed)
+            self.pending = self.draw()
+            self.active = [list(group) for group in self.pending]
+        return
+
+    @property
+    def exact(self):
+        return self.sketch_dim is None and self.sample_rate is None and self.dtype == torch.float32
+
+    def state_dict(self):
+        # the flat tensor, plus the samples and the generator that draws them when sampling
+        if not self.sample_rate:
+            return self.flat
+        return {"flat": self.flat, "active": self.active, "pending": self.pending,
+                "num_advance": self.num_advance, "generator": self.generator.get_state()}
+
+    def load_state_dict(self, state) -> None:
+        if torch.is_tensor(state):
+            self.flat.copy_(state)
+            return
+        self.flat.copy_(state["flat"])
+        device = self.flat.device
+        self.active, self.pending = [[[sample.to(device) if torch.is_tensor(sample) else sample for sample in group]
+                                      for group in state[key]] for key in ("active", "pending")]
+        self.num_advance = state["num_advance"]
+        self.generator.set_state(state["generator"])
+        return
+
+    def draw(self):
+        # coordinate indices per param, or whether each param is in the sample
+        if self.sample_mode == COORDINATE:
+            return [[torch.randint(0, numel, (view.numel(),), generator=self.generator, device=self.flat.device)
+                     for numel, view in zip(numels, views)] for numels, views in zip(self.numels, self.views)]
+        keep = torch.rand(sum(len(numels) for numels in self.numels), generator=self.generator, device=self.flat.device)
+        keep = (keep < self.sample_rate).tolist()
+        return [keep[first:first+len(numels)] for first, numels in zip(self.first_index, self.numels)]
+
+    def advance(self) -> None:
+        # called once per scheduler step, draws a new sample every resample_interval calls
+        if not self.sample_rate:
+            return
+        self.num_advance += 1
+        if self.num_advance % self.resample_interval == 0:
+            self.pending = self.draw()
+        return
+
+    def sampled(self, lr_idx, i):
+        # whether the next write to this param is stored, the caller may skip computing it if not
+        return not self.sample_rate or self.sample_mode == COORDINATE or self.pending[lr_idx][i]
+
+    def sample(self, value, indices):
+        # values at logical (row major) indices, read through value's strides without a copy
+        return torch.take(value, indices).float()
+
+    def sketch(self, lr_idx, i, value):
+        view = self.views[lr_idx][i]
+        width = view.numel()
+        value = value.reshape(-1).float()
+        # the same random signs for a param on every call, regenerated instead of stored
+        self.generator.manual_seed(self.seed+self.first_index[lr_idx]+i)
+        signs = torch.randint(0, 2, value.size(), generator=self.generator, device=value.device).mul_(2).sub_(1)
+        value = torch.mul(value, signs)
+        value = F.pad(value, (0, (-value.numel()) % width))
+        return value.view(-1, width).sum(0)
+
+    def dot(self, lr_idx, i, grad):
+        view = self.views[lr_idx][i]
+        if self.sketch_dim:
+            return torch.sum(torch.mul(view, self.sketch(lr_idx, i, grad)))
+        if self.sample_rate and self.sample_mode == COORDINATE:
+            indices = self.active[lr_idx][i]
+            return torch.sum(torch.mul(view.float(), self.sample(grad, indices)))*(self.numels[lr_idx][i]/view.numel())
+        if self.sample_rate and not self.active[lr_idx][i]:
+            return 0
+        if view.dtype != grad.dtype:
+            view = view.to(grad.dtype)
+        dot = torch.sum(torch.mul(view, grad))
+        return dot/self.sample_rate if self.sample_rate else dot
+
+    def add_(self, lr_idx, i, value) -> None:
+        # with sample_rate value None only moves the param to the pending sample
+        if self.sample_rate:
+            if not self.switch(lr_idx, i) or value is None:
+                return
+            if self.sample_mode == COORDINATE:
+                value = self.sample(value, self.active[lr_idx][i])
+        if self.sketch_dim:
+            value = self.sketch(lr_idx, i, value)
+        self.views[lr_idx][i] += value
+        return
+
+    def copy_(self, lr_idx, i, value) -> None:
+        if self.sample_rate:
+            if not self.switch(lr_idx, i):
+                return
+            if value is not None and self.sample_mode == COORDINATE:
+                value = self.sample(value, self.active[lr_idx][i])
+        if value is None:
+            self.views[lr_idx][i].zero_()
+        elif self.sketch_dim:
+            self.views[lr_idx][i].copy_(self.sketch(lr_idx, i, value))
+        else:
+            self.views[lr_idx][i].copy_(value)
+        return
+
+    def switch(self, lr_idx, i):
+        # moves the param to the pending sample, returns whether anything of it is stored
+        self.active[lr_idx][i] = self.pending[lr_idx][i]
+        return self.sample_mode == COORDINATE or self.active[lr_idx][i]
+
+    def foreach_add_(self, lr_idx, indices, values) -> None:
+        if self.exact:
+            torch._foreach_add_([self.views[lr_idx][i] for i in indices], values)
+            return
+        for i, value in zip(indices, values):
+            self.add_(lr_idx, i, value)
+        return
+
+    def foreach_copy_(self, lr_idx, indices, values) -> None:
+        if self.exact:
+            torch._foreach_copy_([self.views[lr_idx][i] for i in indices], values)
+            return
+        for i, value in zip(indices, values):
+            self.copy_(lr_idx, i, value)
+        return
+
+    def zero_(self) -> None:
+        self.flat.zero_()
+        return
+
+
+def adam_direction(optimizer, group, param):
+    # the adam update direction of param, recomputed from the optimizer state after its step
+    grad = param.grad.data
+    exp_avg = optimizer.state[param]["exp_avg"].data
+    exp_avg_sq = optimizer.state[param]["exp_avg_sq"].data
+    step = optimizer.state[param]["step"]
+    beta1, beta2 = group['betas']
+    weight_decay = group['weight_decay']
+    eps = group["eps"]
+
+    bias_correction1 = 1 - beta1 ** step
+    bias_correction2 = 1 - beta2 ** step
+
+    if weight_decay != 0:
+        grad = grad.add(param, alpha=weight_decay)
+
+    numer = exp_avg.mul(beta1).add(grad, alpha=1 - beta1).div(bias_correction1)
+    denom = (exp_avg_sq.mul(beta2).addcmul(grad, grad, value=1 - beta2).sqrt() / math.sqrt(bias_correction2)).add(eps)
+    return torch.div(numer, denom).data
+
+
+def numel_chunks(indices, params, max_numel):
+    # split a group's params into runs of at most max_numel elements (single params may exceed it),
+    # which bounds the temporaries of the multi-tensor paths
+    chunk_indices, chunk_params, numel = [], [], 0
+    for i, param in zip(indices, params):
+        if len(chunk_params) != 0 and numel+param.numel() > max_numel:
+            yield chunk_indices, chunk_params
+            chunk_indices, chunk_params, numel = [], [], 0
+        chunk_indices.append(i)
+        chunk_params.append(param)
+        numel += param.numel()
+    if len(chunk_params) != 0:
+        yield chunk_indices, chunk_params
+
+
+@torch.no_grad()
+def foreach_adam_directions(optimizer, group, params):
+    # adam_direction for a list of params of one group with multi-tensor kernels, reusing the
+    # numerator lists for the result so only the numerator and denominator are materialized
+    beta1, beta2 = group['betas']
+    weight_decay = group['weight_decay']
+    eps = group["eps"]
+    grads = [param.grad.data for param in params]
+    exp_avgs = [optimizer.state[param]["exp_avg"].data for param in params]
+    exp_avg_sqs = [optimizer.state[param]["exp_avg_sq"].data for param in params]
+    # the steps are cpu tensors (or floats), these corrections never touch the device
+    bias_corrections1 = [float(1 - beta1 ** optimizer.state[param]["step"]) for param in params]
+    bias_corrections2 = [math.sqrt(1 - beta2 ** optimizer.state[param]["step"]) for param in params]
+
+    if weight_decay != 0:
+        grads = torch._foreach_add(grads, params, alpha=weight_decay)
+
+    numer = torch._foreach_mul(exp_avgs, beta1)
+    torch._foreach_add_(numer, grads, alpha=1 - beta1)
+    torch._foreach_div_(numer, bias_corrections1)
+    denom = torch._foreach_mul(exp_avg_sqs, beta2)
+    torch._foreach_addcmul_(denom, grads, grads, value=1 - beta2)
+    torch._foreach_sqrt_(denom)
+    torch._foreach_div_(denom, bias_corrections2)
+    torch._foreach_add_(denom, eps)
+    torch._foreach_div_(numer, denom)
+    return numer
+
+
+def iter_tensors(value):
+    if torch.is_tensor(value):
+        yield value
+    elif isinstance(value, (list, tuple)):
+        for item in value:
+            yield from iter_tensors(item)
+    elif isinstance(value, dict):
+        for item in value.values():
+            yield from iter_tensors(item)
+    elif isinstance(value, HyperBuffer):
+        yield from iter_tensors(vars(value))
+
+
+# scheduler attributes left out of state_dict: the optimizer, what is rebuilt from it and the
+# constructor settings
+UNSAVED = ("optimizer", "step_hook", "flat_grad", "grad_views", "flat_chunks", "flat_product", "grad_positions",
+           "foreach", "foreach_chunk", "distributed", "meta_lr", "max_lr", "min_lr", "loss_decay",
+           "weight_decay", "reference_lr", "param_layer", "num_layers", "device_lr")
+
+
+class BaseAdaptiveLR(_LRScheduler):
+    # shared lr state of the hypergradient and adapt detection schedulers. subclasses set
+    # meta_lr/max_lr/min_lr and their buffers before calling this __init__.
+    # sync_free keeps the lrs and lr grads as packed device vectors and clamps them on device, so
+    # buffer_step never reads a value back to the host. the optimizer needs host lrs (torch.optim
+    # turns tensor lrs into python scalars, a sync per group or param, unless adam is capturable or
+    # fused), buffered schedulers read the vector back once per lr update. of the per batch ones
+    # HyperGradientLR (plain sgd only) keeps the group lrs fixed and scales the grads to the vector's
+    # lrs in a step pre hook, HyperGradientMomentumLR reads the vector back once per step and
+    # HyperGradientAdamLR hands a tensor lr adam views of it. use read_lr() to log them.
+    # distributed (default: whether torch.distributed is initialized) averages the lr grads of all
+    # groups over the ranks in one all_reduce before every lr update, so all ranks apply the same lrs
+    def __init__(self, optimizer, last_epoch: int = -1, verbose=False, sync_free=False, distributed=None) -> None:
+        self.sync_free = sync_free
+        if distributed is None:
+            distributed = dist.is_available() and dist.is_initialized()
+        self.distributed = distributed
+        num_groups = len(optimizer.param_groups)
+        if sync_free:
+            device = optimizer.param_groups[0]["params"][0].device
+            self.lr_vector = torch.tensor([float(group["lr"]) for group in optimizer.param_groups], device=device)
+            self.last_lr_grad = torch.zeros(num_groups, device=device)
+        else:
+            self.last_lr_grad = [0] * num_groups
+        super(BaseAdaptiveLR, self).__init__(optimizer, last_epoch, verbose)
+        return
+
+    def init_foreach(self, optimizer, foreach, foreach_chunk) -> None:
+        # the multi-tensor paths, on by default for cuda params like torch.optim. they work on at most
+        # foreach_chunk elements at a time to bound their temporaries. subclasses call it before __init__
+        if foreach is None:
+            foreach = all(param.is_cuda for group in optimizer.param_groups for param in group["params"])
+        self.foreach = foreach
+        self.foreach_chunk = foreach_chunk
+        return
+
+    def init_grad_scaling(self, optimizer) -> None:
+        # for schedulers that keep the group lrs fixed and apply their own lrs by scaling the grads
+        # in a step pre hook (their scale_grads, see scale_param_grads). the groups' weight decay is
+        # taken over, it has to be scaled with the grads
+        self.weight_decay = [group["weight_decay"] for group in optimizer.param_groups]
+        for group in optimizer.param_groups:
+            group["weight_decay"] = 0
+        self.step_hook = optimizer.register_step_pre_hook(self.scale_grads)
+        return
+
+    def scale_param_grads(self, lr_idx, params, ratios) -> None:
+        # lr*(grad+wd*param) = group lr*ratio*(grad+wd*param), ratio = lr/group lr per group (one
+        # scalar) or per param (a list). param.grad is lr scaled after optimizer.step(), anything
+        # reading the grads afterwards sees the scaled values
+        grads = [param.grad.data for param in params]
+        if self.weight_decay[lr_idx] != 0:
+            torch._foreach_add_(grads, params, alpha=self.weight_decay[lr_idx])
+        torch._foreach_mul_(grads, ratios)
+        return
+
+    def all_reduce_lr_grads(self, lr_grads):
+        # one collective for every group: the lr grads packed into a vector, summed and averaged
+        device = self.optimizer.param_groups[0]["params"][0].device
+        if torch.is_tensor(lr_grads):
+            packed = lr_grads.float().clone()
+        else:
+            packed = torch.stack([torch.as_tensor(grad, dtype=torch.float32, device=device) for grad in lr_grads])
+        dist.all_reduce(packed)
+        packed /= dist.get_world_size()
+        return packed if self.sync_free else packed.tolist()
+
+    def clamp_lr(self, lr_grads) -> list:
+        if self.sync_free:
+            self.update_lr_vector(lr_grads)
+            # one read back for all groups per lr update
+            return self.lr_vector.tolist()
+        if self.distributed:
+            lr_grads = self.all_reduce_lr_grads(lr_grads)
+        self.applied_lr_grad = list(lr_grads)
+        lrs = []
+        for lr_idx, group in enumerate(self.optimizer.param_groups):
+            tmp_lr = group['lr']+self.meta_lr*lr_grads[lr_idx]
+            if tmp_lr > self.max_lr:
+                lrs.append(self.max_lr)
+            elif tmp_lr < self.min_lr:
+                lrs.append(self.min_lr)
+            else:
+                lrs.append(tmp_lr)
+        return lrs
+
+    def update_lr_vector(self, lr_grads) -> None:
+        # the sync_free lr update, on the device
+        if self.distributed:
+            lr_grads = self.all_reduce_lr_grads(lr_grads)
+        if not torch.is_tensor(lr_grads):
+            lr_grads = torch.stack([grad if torch.is_tensor(grad) else self.lr_vector.new_full((), grad)
+                                    for grad in lr_grads])
+        # kept for read_lr_grad(), last_lr_grad itself is reset after the update
+        self.applied_lr_grad = lr_grads.clone() if lr_grads is self.last_lr_grad else lr_grads
+        torch.clamp(self.lr_vector+self.meta_lr*lr_grads, self.min_lr, self.max_lr, out=self.lr_vector)
+        return
+
+    def reset_lr_grad(self) -> None:
+        if self.sync_free:
+            self.last_lr_grad.zero_()
+        else:
+            self.last_lr_grad = [0] * len(self.optimizer.param_groups)
+        return
+
+    def read_lr(self) -> list:
+        # host copy of the current lrs, a single device sync in sync_free mode
+        if self.sync_free:
+            return self.lr_vector.tolist()
+        return [float(group["lr"]) for group in self.optimizer.param_groups]
+
+    def read_lr_grad(self) -> list:
+        # host copy of the lr grads (hypergradients) of the last lr update, per group
+        if self.sync_free:
+            return self.applied_lr_grad.tolist()
+        return [float(grad) for grad in self.applied_lr_grad]
+
+    def state_dict(self) -> dict:
+        # lrs, lr grads and buffers, a HyperBuffer as its flat tensor (and its samples). the per-param
+        # views and the foreach scratch are rebuilt from the optimizer, the constructor settings stay
+        # those of the scheduler loading the state (a cuda checkpoint resumed on cpu runs without
+        # foreach, a ddp one resumed in one process without all_reduce). sync_free is kept to reject
+        # a resume into the other mode, it decides the form of the lr state
+        state = {}
+        for key, value in self.__dict__.items():
+            if key in UNSAVED:
+                continue
+            state[key] = value.state_dict() if isinstance(value, HyperBuffer) else value
+        return state
+
+    def load_state_dict(self, state_dict) -> None:
+        if state_dict.get("sync_free", self.sync_free) != self.sync_free:
+            raise ValueError(f"state of a scheduler with sync_free={state_dict['sync_free']}, this one has sync_free={self.sync_free}")
+        for key, value in state_dict.items():
+            if key in UNSAVED:
+                # older checkpoints saved the settings too
+                continue
+            current = self.__dict__.get(key)
+            if isinstance(current, HyperBuffer):
+                current.load_state_dict(value)
+            elif torch.is_tensor(current) and torch.is_tensor(value):
+                # in place, keeps the device vectors the schedulers hold on to
+                current.copy_(value)
+            else:
+                self.__dict__[key] = value
+        return
+
+    def memory_footprint(self) -> dict:
+        # bytes held by the scheduler on top of the optimizer, per attribute and in total.
+        # views share their storage, so every storage is counted once.
+        footprint = {}
+        seen = set()
+        for name, value in vars(self).items():
+            if name == "optimizer":
+                continue
+            nbytes = 0
+            for tensor in iter_tensors(value):
+                storage = tensor.untyped_storage()
+                if storage.data_ptr() in seen:
+                    continue
+                seen.add(storage.data_ptr())
+                nbytes += storage.nbytes()
+            if nbytes:
+                footprint[name] = nbytes
+        footprint["total"] = sum(footprint.values())
+        return footprint
@@ -1,122 +1,149 @@
 from torch.optim.optimizer import Optimizer
-from torch.optim.lr_scheduler import _LRScheduler
+from const import COORDINATE, PER_BATCH
+from model.base import BaseAdaptiveLR, HyperBuffer, adam_direction, foreach_adam_directions, numel_chunks
 import torch
-import torch.nn.functional as F
-from torch import Tensor
-from typing import List, Optional
-import math
 
 
-class HyperGradientLR(_LRScheduler):
-    def __init__(self, optimizer: Optimizer, meta_lr=1e-4, last_epoch: int = -1, verbose=False) -> None:
-        self.last_param_grad = []
-        for param in optimizer.param_groups[0]["params"]:
-            self.last_param_grad.append(torch.zeros(
-                param.size(), device=param.device))
+class HyperGradientLR(BaseAdaptiveLR):
+    # sync_free (plain sgd only) keeps the group lrs at their initial values: a step pre hook takes
+    # the lr grads from the raw grads, then scales the grads by lr/group lr (scale_param_grads), so
+    # the optimizer applies the device lrs without reading them
+    step_mode = PER_BATCH
+
+    def __init__(self, optimizer: Optimizer, meta_lr=1e-4, last_epoch: int = -1, verbose=False, sync_free=False, buffer_dtype=None, sketch_dim=None, sample_rate=None, sample_mode=COORDINATE, resample_interval=1, distributed=None) -> None:
+        if sync_free and not (isinstance(optimizer, torch.optim.SGD) and
+                              all(group["momentum"] == 0 and not group["nesterov"] for group in optimizer.param_groups)):
+            raise ValueError("sync_free HyperGradientLR takes plain sgd, without momentum or nesterov")
+        self.last_param_grad = HyperBuffer(optimizer.param_groups, buffer_dtype, sketch_dim, sample_rate=sample_rate, sample_mode=sample_mode, resample_interval=resample_interval)
         self.meta_lr = meta_lr
         self.max_lr = 0.5
         self.min_lr = 0.000001
-        super(HyperGradientLR, self).__init__(optimizer, last_epoch, verbose)
+        super(HyperGradientLR, self).__init__(optimizer, last_epoch, verbose, sync_free, distributed)
+        if sync_free:
+            self.reference_lr = torch.tensor([float(group["lr"]) for group in optimizer.param_groups], device=self.lr_vector.device)
+            self.init_grad_scaling(optimizer)
         return
 
     def get_lr(self) -> float:
-        lrs = []
-        for group in self.optimizer.param_groups:
+        if self.sync_free:
+            # the lr grads were taken by scale_grads, the group lrs stay the reference
+            self.update_lr_vector(self.last_lr_grad)
+            self.reset_lr_grad()
+            return [group["lr"] for group in self.optimizer.param_groups]
+        return list(self.clamp_lr(self.lr_grads()))
+
+    def lr_grads(self) -> list:
+        lr_grads = []
+        for lr_idx, group in enumerate(self.optimizer.param_groups):
             grad = 0
             for i, param in enumerate(group["params"]):
                 if param.grad != None:
-                    grad += torch.sum(torch.mul(self.last_param_grad[i], param.grad.data))
-                    self.last_param_grad[i] = param.grad.data.clone()
+                    grad += self.last_param_grad.dot(lr_idx, i, param.grad.data)
+                    self.last_param_grad.copy_(lr_idx, i, param.grad.data)
                 else:
-                    self.last_param_grad[i] = torch.zeros(
-                        param.size(), device=param.device)
-            tmp_lr = group['lr']+self.meta_lr*grad
-            if tmp_lr > self.max_lr:
-                lrs.append(self.max_lr)
-            elif tmp_lr < self.min_lr:
-                lrs.append(self.min_lr)
-            else:
-                lrs.append(tmp_lr)
-        return list(lrs)
+                    self.last_param_grad.copy_(lr_idx, i, None)
+            lr_grads.append(grad)
+        self.last_param_grad.advance()
+        return lr_grads
+
+    @torch.no_grad()
+    def scale_grads(self, optimizer, args, kwargs) -> None:
+        self.last_lr_grad += torch.stack([torch.as_tensor(grad, dtype=torch.float32, device=self.lr_vector.device)
+                                          for grad in self.lr_grads()])
+        ratios = (self.lr_vector/self.reference_lr).unbind(0)
+        for lr_idx, group in enumerate(self.optimizer.param_groups):
+            params = [param for param in group["params"] if param.grad is not None]
+            if len(params) == 0:
+                continue
+            # the single tensor overload keeps it one multi-tensor launch, a list of 0-dim device
+            # tensors would take the per-tensor path
+            self.scale_param_grads(lr_idx, params, ratios[lr_idx])
+        return
+
 
+class HyperGradientMomentumLR(BaseAdaptiveLR):
+    # sync_free clamps the packed lr vector on the device and reads it back once per step for the
+    # optimizer, instead of two host comparisons per group. grads are not scaled as in
+    # HyperGradientLR, the momentum buffer would keep grads scaled by older lrs
+    step_mode = PER_BATCH
 
-class HyperGradientMomentumLR(_LRScheduler):
-    def __init__(self, optimizer: torch.optim.SGD, meta_lr=1e-4, last_epoch: int = -1, verbose=False) -> None:
-        self.last_momentum_buffer = []
-        for param in optimizer.param_groups[0]["params"]:
-            self.last_momentum_buffer.append(torch.zeros(
-                param.size(), device=param.device))
+    def __init__(self, optimizer: torch.optim.SGD, meta_lr=1e-4, last_epoch: int = -1, verbose=False, sync_free=False, buffer_dtype=None, sketch_dim=None, sample_rate=None, sample_mode=COORDINATE, resample_interval=1, distributed=None) -> None:
+        self.last_momentum_buffer = HyperBuffer(optimizer.param_groups, buffer_dtype, sketch_dim, sample_rate=sample_rate, sample_mode=sample_mode, resample_interval=resample_interval)
         self.meta_lr = meta_lr
         self.max_lr = 0.5
         self.min_lr = 0.000001
-        super(HyperGradientMomentumLR, self).__init__(optimizer, last_epoch, verbose)
+        super(HyperGradientMomentumLR, self).__init__(optimizer, last_epoch, verbose, sync_free, distributed)
         return
 
     def get_lr(self) -> float:
-        lrs = []
-        for group in self.optimizer.param_groups:
+        lr_grads = []
+        for lr_idx, group in enumerate(self.optimizer.param_groups):
             grad = 0
             for i, param in enumerate(group["params"]):
                 if param.grad != None:
-                    grad += torch.sum(torch.mul(self.last_momentum_buffer[i], param.grad.data))
-                    self.last_momentum_buffer[i] = self.optimizer.state[param]["momentum_buffer"].data.clone()
+                    grad += self.last_momentum_buffer.dot(lr_idx, i, param.grad.data)
+                    self.last_momentum_buffer.copy_(lr_idx, i, self.optimizer.state[param]["momentum_buffer"].data)
                 else:
-                    self.last_momentum_buffer[i] = torch.zeros(
-                        param.size(), device=param.device)
-            tmp_lr = group['lr']+self.meta_lr*grad
-            if tmp_lr > self.max_lr:
-                lrs.append(self.max_lr)
-            elif tmp_lr < self.min_lr:
-                lrs.append(self.min_lr)
-            else:
-                lrs.append(tmp_lr)
-        return list(lrs)
+                    self.last_momentum_buffer.copy_(lr_idx, i, None)
+            lr_grads.append(grad)
+        self.last_momentum_buffer.advance()
+        return list(self.clamp_lr(lr_grads))
+
 
+class HyperGradientAdamLR(BaseAdaptiveLR):
+    # sync_free clamps the packed lr vector on the device. an adam built with tensor lrs (which
+    # torch.optim takes with capturable=True or fused=True) gets 0-dim views of the vector as its
+    # lrs and no step reads an lr back, with float lrs the vector is read back once per step as in
+    # HyperGradientMomentumLR
+    step_mode = PER_BATCH
 
-class HyperGradientAdamLR(_LRScheduler):
-    def __init__(self, optimizer: torch.optim.Adam, meta_lr=1e-6, last_epoch: int = -1, verbose=False) -> None:
-        self.last_adam_buffer = []
-        for param in optimizer.param_groups[0]["params"]:
-            self.last_adam_buffer.append(torch.zeros(
-                param.size(), device=param.device))
+    def __init__(self, optimizer: torch.optim.Adam, meta_lr=1e-6, last_epoch: int = -1, verbose=False, sync_free=False, buffer_dtype=None, sketch_dim=None, sample_rate=None, sample_mode=COORDINATE, resample_interval=1, distributed=None, foreach=None, foreach_chunk=2**22) -> None:
+        self.device_lr = sync_free and all(torch.is_tensor(group["lr"]) for group in optimizer.param_groups)
+        self.last_adam_buffer = HyperBuffer(optimizer.param_groups, buffer_dtype, sketch_dim, sample_rate=sample_rate, sample_mode=sample_mode, resample_interval=resample_interval)
         self.meta_lr = meta_lr
         self.max_lr = 0.005
         self.min_lr = 0.000001
-        super(HyperGradientAdamLR, self).__init__(optimizer, last_epoch, verbose)
+        self.init_foreach(optimizer, foreach, foreach_chunk)
+        super(HyperGradientAdamLR, self).__init__(optimizer, last_epoch, verbose, sync_free, distributed)
         return
 
     def get_lr(self) -> float:
-        lrs = []
-        for group in self.optimizer.param_groups:
+        lr_grads = []
+        for lr_idx, group in enumerate(self.optimizer.param_groups):
+            if self.foreach:
+                lr_grads.append(self._foreach_lr_grad(lr_idx, group))
+                continue
             lr_grad = 0
             for i, param in enumerate(group["params"]):
                 if param.grad != None:
-                    lr_grad += torch.sum(torch.mul(self.last_adam_buffer[i], param.grad.data))
-                    grad = param.grad.data
-                    exp_avg = self.optimizer.state[param]["exp_avg"].data
-                    exp_avg_sq = self.optimizer.state[param]["exp_avg_sq"].data
-                    step = self.optimizer.state[param]["step"]
-                    beta1, beta2 = group['betas']
-                    weight_decay = group['weight_decay']
-                    eps = group["eps"]
-
-                    bias_correction1 = 1 - beta1 ** step
-                    bias_correction2 = 1 - beta2 ** step
-
-                    if weight_decay != 0:
-                        grad = grad.add(param, alpha=weight_decay)
+                    lr_grad += self.last_adam_buffer.dot(lr_idx, i, param.grad.data)
+                    if self.last_adam_buffer.sampled(lr_idx, i):
+                        self.last_adam_buffer.copy_(lr_idx, i, adam_direction(self.optimizer, group, param))
+                    else:
+                        self.last_adam_buffer.copy_(lr_idx, i, None)
+                else:
+                    self.last_adam_buffer.copy_(lr_idx, i, None)
+            lr_grads.append(lr_grad)
+        self.last_adam_buffer.advance()
+        if self.device_lr:
+            self.update_lr_vector(lr_grads)
+            return list(self.lr_vector.unbind(0))
+        return list(self.clamp_lr(lr_grads))
 
-                    numer = exp_avg.mul(beta1).add(grad, alpha=1 - beta1).div(bias_correction1)
-                    denom = (exp_avg_sq.mul(beta2).addcmul(grad, grad, value=1 - beta2).sqrt() / math.sqrt(bias_correction2)).add(eps)
-                    self.last_adam_buffer[i] = torch.div(numer, denom).data.clone()
+    def _foreach_lr_grad(self, lr_idx, group):
+        lr_grad = 0
+        indices = []
+        for i, param in enumerate(group["params"]):
+            if param.grad is not None:
+                lr_grad += self.last_adam_buffer.dot(lr_idx, i, param.grad.data)
+                if self.last_adam_buffer.sampled(lr_idx, i):
+                    indices.append(i)
                 else:
-                    self.last_adam_buffer[i] = torch.zeros(
-                        param.size(), device=param.device)
-            tmp_lr = group['lr']+self.meta_lr*lr_grad
-            if tmp_lr > self.max_lr:
-                lrs.append(self.max_lr)
-            elif tmp_lr < self.min_lr:
-                lrs.append(self.min_lr)
+                    self.last_adam_buffer.copy_(lr_idx, i, None)
             else:
-                lrs.append(tmp_lr)
-        return list(lrs)
+                self.last_adam_buffer.copy_(lr_idx, i, None)
+        params = [group["params"][i] for i in indices]
+        for chunk_indices, chunk_params in numel_chunks(indices, params, self.foreach_chunk):
+            directions = foreach_adam_directions(self.optimizer, group, chunk_params)
+            self.last_adam_buffer.foreach_copy_(lr_idx, chunk_indices, directions)
+        return lr_grad
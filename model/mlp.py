@@ -0,0 +1,26 @@
+from torch import nn
+import torch.nn.functional as F
+
+
+class MLP(nn.Module):
+    def __init__(self, input_dim, num_classes, hidden_dims=[64, 64]):
+        super(MLP, self).__init__()
+        dims = [input_dim] + list(hidden_dims)
+        self.hiddens = nn.ModuleList([nn.Linear(in_dim, out_dim) for in_dim, out_dim in zip(dims[:-1], dims[1:])])
+        self.linear = nn.Linear(dims[-1], num_classes)
+
+    def forward(self, x):
+        out = x
+        for hidden in self.hiddens:
+            out = F.relu(hidden(out))
+        out = self.linear(out)
+        return out
+
+    def parameters_layerwise(self):
+        param_groups = []
+        for name, param in self.named_parameters():
+            if name.__contains__("bias"):
+                param_groups[-1]["params"].append(param)
+            else:
+                param_groups.append({"params": [param]})
+        return param_groups
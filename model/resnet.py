@@ -1,7 +1,25 @@
+import copy
 from torch import nn
+from torch.nn.utils.fusion import fuse_conv_bn_eval
 import torch.nn.functional as F
 
 
+def fold_conv_bn(module):
+    # replaces every conv followed by a batchnorm (convN/bnN attribute pairs and conv, bn sequences)
+    # by one conv with the eval mode normalization folded into its weight and bias, in place
+    for name, child in module.named_children():
+        if isinstance(child, nn.Sequential) and len(child) == 2 and isinstance(child[0], nn.Conv2d) \
+                and isinstance(child[1], nn.BatchNorm2d):
+            child[0] = fuse_conv_bn_eval(child[0], child[1])
+            child[1] = nn.Identity()
+        elif isinstance(child, nn.Conv2d) and isinstance(getattr(module, name.replace("conv", "bn"), None), nn.BatchNorm2d):
+            setattr(module, name, fuse_conv_bn_eval(child, getattr(module, name.replace("conv", "bn"))))
+            setattr(module, name.replace("conv", "bn"), nn.Identity())
+        else:
+            fold_conv_bn(child)
+    return module
+
+
 class BasicBlock(nn.Module):
     expansion = 1
 
@@ -101,6 +119,10 @@ class ResNet(nn.Module):
         out = self.linear(out)
         return out
 
+    def fold_bn(self):
+        # an eval only copy with every batchnorm folded into the conv before it
+        return fold_conv_bn(copy.deepcopy(self).eval())
+
     def parameters_layerwise(self):
         param_groups = []
         for name, param in self.named_parameters():
@@ -0,0 +1,237 @@
+import argparse
+import contextlib
+import hashlib
+import itertools
+import json
+import multiprocessing as mp
+import multiprocessing.connection as mp_connection
+import os
+import pandas as pd
+import torch
+import traceback
+from time import time
+from const import *
+
+# grid axes, a run is one value of each. meta_lr only applies to the hd and ads families
+AXES = ["dataset", "optimizer", "scheduler", "meta_lr", "seed"]
+TABULAR = [IRIS, WINE, CAR, AGARICUS]
+OPTIMIZERS = {
+    "sgd": (torch.optim.SGD, {"lr": 0.1, "weight_decay": 1e-4}),
+    "momentum": (torch.optim.SGD, {"lr": 0.1, "momentum": 0.9, "weight_decay": 1e-4}),
+    "adam": (torch.optim.Adam, {"lr": 0.001, "weight_decay": 1e-4}),
+}
+SCHEDULERS = ["blank", "cosine", "hd", "ads"]
+# set by pin_worker in every run process
+WORKER_DEVICE = None
+
+
+def expand_grid(grid):
+    # the runs of a grid dict (axis -> list of values), one config each, without duplicates
+    configs = []
+    for values in itertools.product(*[grid.get(axis, [None]) for axis in AXES]):
+        config = dict(zip(AXES, values))
+        if config["scheduler"] not in ["hd", "ads"]:
+            config["meta_lr"] = None
+        config["layerwise"] = grid.get("layerwise", False)
+        config["epochs"] = grid.get("epochs", EPOCHS)
+        if config not in configs:
+            configs.append(config)
+    return configs
+
+
+def run_id(config):
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:12]
+
+
+def build_scheduler(family, optimizer, meta_lr, epochs):
+    from model.blank import BlankLR
+    from model.hypergradient import HyperGradientLR, HyperGradientAdamLR, HyperGradientMomentumLR
+    from model.adaptdetection import AdaptDectectionLR, AdaptDectectionAdamLR, AdaptDectectionMomentumLR
+    kwargs = {} if meta_lr is None else {"meta_lr": meta_lr}
+    if family == "blank":
+        return BlankLR(optimizer)
+    if family == "cosine":
+        return torch.optim.lr_scheduler.CosineAnnealingLR(optimizer, epochs, eta_min=0.001)
+    if isinstance(optimizer, torch.optim.Adam):
+        cls = HyperGradientAdamLR if family == "hd" else AdaptDectectionAdamLR
+    elif optimizer.defaults["momentum"] != 0:
+        cls = HyperGradientMomentumLR if family == "hd" else AdaptDectectionMomentumLR
+    else:
+        cls = HyperGradientLR if family == "hd" else AdaptDectectionLR
+    return cls(optimizer, **kwargs)
+
+
+def pin_worker(slot, num_workers):
+    # a run takes a slot: its own share of the cores, and a gpu round robin when there are any.
+    # without core affinity (macos, windows) it only takes its share of the threads
+    if hasattr(os, "sched_setaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+        per_worker = max(1, len(cores)//num_workers)
+        own = cores[slot*per_worker % len(cores):][:per_worker]
+        os.sched_setaffinity(0, own)
+        torch.set_num_threads(len(own))
+    else:
+        torch.set_num_threads(max(1, os.cpu_count()//num_workers))
+    global WORKER_DEVICE
+    WORKER_DEVICE = f"cuda:{slot % torch.cuda.device_count()}" if torch.cuda.is_available() else "cpu"
+    return
+
+
+def run(config, out_dir):
+    # one training run, its epoch records go to <out_dir>/<run id>.json once it finished and its
+    # output to <run id>.log. a run without a result file is run again by the next invocation, and
+    # resumes from the checkpoint in <out_dir>/<run id>/ that it writes every epoch
+    from trainers import Trainer, HDTrainer, ADSTrainer, TabularTrainer
+    name = run_id(config)
+    run_dir = os.path.join(out_dir, name)
+    os.makedirs(run_dir, exist_ok=True)
+    records_path = os.path.join(run_dir, "records.jsonl")
+    st_time = time()
+    try:
+        with open(os.path.join(out_dir, f"{name}.log"), "a") as log, contextlib.redirect_stdout(log):
+            torch.manual_seed(config["seed"])
+            kwargs = {"device": WORKER_DEVICE, "checkpoint_path": os.path.join(run_dir, "checkpoint.ckpt")}
+            if config["dataset"] in TABULAR:
+                trainer = TabularTrainer(config["dataset"], **kwargs)
+            else:
+                trainer = {"hd": HDTrainer, "ads": ADSTrainer}.get(config["scheduler"], Trainer)(config["dataset"], **kwargs)
+            cls, kwargs = OPTIMIZERS[config["optimizer"]]
+            params = trainer.model.parameters_layerwise() if config["layerwise"] else trainer.model.parameters()
+            optimizer = cls(params, **kwargs)
+            trainer.set_optimizer(optimizer)
+            trainer.set_scheduler(build_scheduler(config["scheduler"], optimizer, config["meta_lr"], config["epochs"]))
+            trainer.register_epoch_hook(lambda trainer, epoch, record: append_record(records_path, record))
+            trainer.train(load=os.path.exists(trainer.checkpoint_path), save=True, epochs=config["epochs"])
+        records = read_records(records_path, config["epochs"])
+    except Exception as e:
+        with open(os.path.join(out_dir, f"{name}.log"), "a") as log:
+            traceback.print_exc(file=log)
+        return {"id": name, **config, "status": f"failed: {e!r}", "time": time()-st_time}
+    result = {"id": name, "config": config, "device": WORKER_DEVICE, "records": records, "time": time()-st_time}
+    path = os.path.join(out_dir, f"{name}.json")
+    with open(path+".tmp", "w") as f:
+        json.dump(result, f)
+    os.replace(path+".tmp", path)
+    return summarize(result)
+
+
+def append_record(path, record):
+    with open(path, "a") as f:
+        f.write(json.dumps(record)+"\n")
+    return
+
+
+def read_records(path, epochs):
+    # the epoch records of all attempts of a run, an epoch redone after a resume keeps its last record
+    records = {}
+    with open(path) as f:
+        for line in f:
+            # a line cut short by a crash has no newline yet
+            if not line.endswith("\n"):
+                continue
+            record = json.loads(line)
+            records[record["epoch"]] = record
+    return [records[epoch] for epoch in sorted(records) if epoch <= epochs]
+
+
+def summarize(result):
+    records = result["records"]
+    return {"id": result["id"], **result["config"], "status": "done",
+            "best_val_accu": max(record["val_accu"] for record in records),
+            "val_accu": records[-1]["val_accu"], "val_loss": records[-1]["val_loss"],
+            "train_loss": records[-1]["train_loss"], "time": result["time"]}
+
+
+def run_grid(grid, out_dir="runs", num_workers=None, timeout=None):
+    os.makedirs(out_dir, exist_ok=True)
+    configs = expand_grid(grid)
+    rows, todo = [], []
+    for config in configs:
+        path = os.path.join(out_dir, f"{run_id(config)}.json")
+        if os.path.exists(path):
+            with open(path) as f:
+                rows.append(summarize(json.load(f)))
+        else:
+            todo.append(config)
+    print(f"Grid->runs:{len(configs)}, done:{len(rows)}, todo:{len(todo)}")
+    if len(todo) != 0:
+        if num_workers is None:
+            num_workers = torch.cuda.device_count() if torch.cuda.is_available() else os.cpu_count()
+        num_workers = min(num_workers, len(todo))
+        # one spawned process per run (cuda can not be forked) on a free slot, at most num_workers at
+        # a time. a run that dies hard (segfault, oom kill) or exceeds timeout seconds is recorded as
+        # failed and its slot goes to the next run
+        ctx = mp.get_context("spawn")
+        free, running = list(range(num_workers)), {}
+        while len(todo) != 0 or len(running) != 0:
+            while len(todo) != 0 and len(free) != 0:
+                slot, config = free.pop(0), todo.pop(0)
+                receiver, sender = ctx.Pipe(duplex=False)
+                process = ctx.Process(target=_run, args=(config, out_dir, slot, num_workers, sender))
+                process.start()
+                sender.close()
+                running[process.sentinel] = (process, receiver, slot, config, time())
+            wait_time = None
+            if timeout is not None:
+                wait_time = max(0, min(started for _, _, _, _, started in running.values())+timeout-time())
+            ready = mp_connection.wait(list(running), wait_time)
+            for sentinel in list(running):
+                process, receiver, slot, config, started = running[sentinel]
+                timed_out = sentinel not in ready
+                if timed_out:
+                    if timeout is None or time()-started < timeout:
+                        continue
+                    process.kill()
+                process.join()
+                row = None
+                if not timed_out:
+                    # the row, or EOFError when the process died before sending it
+                    with contextlib.suppress(EOFError):
+                        row = receiver.recv()
+                if row is None:
+                    status = "timeout" if timed_out else f"exit code {process.exitcode}"
+                    row = {"id": run_id(config), **config, "status": f"failed: {status}", "time": time()-started}
+                    with open(os.path.join(out_dir, f"{row['id']}.log"), "a") as log:
+                        print(f"Runner->{row['status']}", file=log)
+                receiver.close()
+                del running[sentinel]
+                free.append(slot)
+                print(f"Run~{row['id']}->status:{row['status']}, time:{round(row['time'], 4)}")
+                rows.append(row)
+    table = pd.DataFrame(rows)
+    table = table.sort_values([axis for axis in AXES if axis in table.columns], na_position="first", ignore_index=True)
+    table.to_csv(os.path.join(out_dir, "results.csv"), index=False)
+    return table
+
+
+def _run(config, out_dir, slot, num_workers, sender):
+    pin_worker(slot, num_workers)
+    sender.send(run(config, out_dir))
+    sender.close()
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--grid", help="json file of axis -> values (plus layerwise, epochs), overrides the flags below")
+    parser.add_argument("--dataset", nargs="+", default=[CIFAR100])
+    parser.add_argument("--optimizer", nargs="+", default=["sgd"], choices=list(OPTIMIZERS))
+    parser.add_argument("--scheduler", nargs="+", default=["ads"], choices=SCHEDULERS)
+    parser.add_argument("--meta-lr", type=float, nargs="+", default=[None])
+    parser.add_argument("--seed", type=int, nargs="+", default=[0])
+    parser.add_argument("--layerwise", action="store_true")
+    parser.add_argument("--epochs", type=int, default=EPOCHS)
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--out", default="runs")
+    parser.add_argument("--timeout", type=float, help="seconds after which a run is killed and recorded as failed")
+    args = parser.parse_args()
+    if args.grid:
+        with open(args.grid) as f:
+            grid = json.load(f)
+    else:
+        grid = {"dataset": args.dataset, "optimizer": args.optimizer, "scheduler": args.scheduler,
+                "meta_lr": args.meta_lr, "seed": args.seed, "layerwise": args.layerwise, "epochs": args.epochs}
+    table = run_grid(grid, args.out, args.workers, args.timeout)
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(table.drop(columns=["id"]).to_string(index=False))
+    pass
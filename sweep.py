@@ -0,0 +1,162 @@
+import argparse
+import copy
+import itertools
+import torch
+import torch.nn.functional as F
+from time import time
+from torch.func import functional_call, grad_and_value, replace_all_batch_norm_modules_, stack_module_state, vmap
+from const import *
+from utils import Data, default_device
+from model.mlp import MLP
+from model.adaptdetection import AdaptDectectionLR
+from model.hypergradient import HyperGradientLR
+
+
+def grid(seeds=[0], meta_lrs=[None], max_lrs=[None], min_lrs=[None]):
+    # every combination as a config, None keeps the scheduler's default
+    return [{"seed": seed, "meta_lr": meta_lr, "max_lr": max_lr, "min_lr": min_lr}
+            for seed, meta_lr, max_lr, min_lr in itertools.product(seeds, meta_lrs, max_lrs, min_lrs)]
+
+
+class Sweep():
+    # N replicas of a small model trained in lockstep with torch.func: the parameters are stacked
+    # along a leading replica dim, loss and grads are vmapped, and plain sgd plus the update rule of
+    # the scheduler act on the stacked tensors. every replica has its own seed (init and batch
+    # order), lrs and hypergradient state, but one process and one kernel launch per op serve them all.
+    # scheduler is AdaptDectectionLR (accumulated grads, lrs move per epoch) or HyperGradientLR (last
+    # grad, lrs move per batch). models with batchnorm train on batch statistics only.
+    def __init__(self, make_model, configs, train_data, test_data, scheduler=AdaptDectectionLR, lr=0.1, weight_decay=0, layerwise=True, batch_size=None, device="cpu") -> None:
+        if scheduler not in (AdaptDectectionLR, HyperGradientLR):
+            raise ValueError(f"{scheduler.__name__} has no vectorized update rule")
+        self.configs = configs
+        self.num_replica = len(configs)
+        self.step_mode = scheduler.step_mode
+        self.weight_decay = weight_decay
+        self.device = device
+        models = []
+        for config in configs:
+            torch.manual_seed(config["seed"])
+            models.append(make_model().to(device))
+        # meta_lr/max_lr/min_lr default to what the scheduler itself would use
+        defaults = scheduler(torch.optim.SGD(models[0].parameters(), lr=lr))
+        self.meta_lr, self.max_lr, self.min_lr = [
+            torch.tensor([config[name] if config.get(name) is not None else getattr(defaults, name) for config in configs],
+                         device=device).view(-1, 1)
+            for name in ["meta_lr", "max_lr", "min_lr"]]
+        # parameter groups of the real optimizer, each param maps to its group's lr column
+        names = {param: name for name, param in models[0].named_parameters()}
+        param_groups = models[0].parameters_layerwise() if layerwise else [{"params": list(models[0].parameters())}]
+        self.group_index = {names[param]: lr_idx for lr_idx, group in enumerate(param_groups) for param in group["params"]}
+        num_groups = len(param_groups)
+        self.lrs = torch.clamp(torch.full((self.num_replica, num_groups), float(lr), device=device), self.min_lr, self.max_lr)
+        self.last_lr_grad = torch.zeros(self.num_replica, num_groups, device=device)
+        # stacked weights and the stateless skeleton the functional calls run through
+        self.params, self.buffers = stack_module_state(models)
+        self.params = {name: param.detach() for name, param in self.params.items()}
+        self.owner_index = torch.tensor([self.group_index[name] for name in self.params], device=device)
+        self.base = copy.deepcopy(models[0]).to("meta")
+        replace_all_batch_norm_modules_(self.base)
+        # accumulated grads for AdaptDectectionLR, last grads for HyperGradientLR
+        self.hyper_buffer = {name: torch.zeros_like(param) for name, param in self.params.items()}
+        self.x_train, self.y_train = [tensor.to(device) for tensor in train_data]
+        self.x_test, self.y_test = [tensor.to(device) for tensor in test_data]
+        self.y_train, self.y_test = self.y_train.long(), self.y_test.long()
+        self.batch_size = batch_size if batch_size else len(self.x_train)
+        self.num_batch = -(-len(self.x_train)//self.batch_size)
+        self.generators = [torch.Generator(device=device).manual_seed(config["seed"]) for config in configs]
+        self.loss_grad = vmap(grad_and_value(self.loss_fn))
+        self.records = [[] for _ in configs]
+        return
+
+    def loss_fn(self, params, buffers, inputs, labels):
+        preds = functional_call(self.base, (params, buffers), (inputs,))
+        return F.cross_entropy(preds, labels)
+
+    def train(self, epochs=EPOCHS):
+        for i in range(epochs):
+            st_time = time()
+            loss_sum = torch.zeros(self.num_replica, device=self.device)
+            # an on device permutation per replica, batches are gathered as (replica, batch, ...)
+            orders = torch.stack([torch.randperm(len(self.x_train), generator=generator, device=self.device)
+                                  for generator in self.generators])
+            for start in range(0, len(self.x_train), self.batch_size):
+                index = orders[:, start:start+self.batch_size]
+                grads, loss = self.loss_grad(self.params, self.buffers, self.x_train[index], self.y_train[index])
+                self.step(grads)
+                loss_sum += loss.detach()*(index.size(1)/len(self.x_train))
+            if self.step_mode == BUFFERED:
+                self.lrs = torch.clamp(self.lrs+self.meta_lr*self.last_lr_grad, self.min_lr, self.max_lr)
+                self.last_lr_grad.zero_()
+                for buffer in self.hyper_buffer.values():
+                    buffer.zero_()
+            val_accu, val_loss = self.val()
+            # one read back of every replica's metrics per epoch
+            train_loss, val_accu, val_loss, lrs = [tensor.tolist() for tensor in (loss_sum, val_accu, val_loss, self.lrs)]
+            for replica in range(self.num_replica):
+                self.records[replica].append({"epoch": i+1, "train_loss": train_loss[replica], "val_loss": val_loss[replica],
+                                              "val_accu": val_accu[replica], "lrs": lrs[replica], "time": time()-st_time})
+        return self.records
+
+    @torch.no_grad()
+    def step(self, grads):
+        # scheduler dot products against the raw grads, reduced per (replica, group)
+        names = list(self.params)
+        dots = torch.stack([torch.sum(torch.mul(self.hyper_buffer[name], grads[name]).flatten(1), 1) for name in names], 1)
+        lr_grads = torch.zeros_like(self.last_lr_grad).index_add_(1, self.owner_index, dots)
+        # sgd with each replica's group lr broadcast over the param
+        for name in names:
+            param, grad = self.params[name], grads[name]
+            lr = self.lrs[:, self.group_index[name]].view(-1, *[1]*(param.dim()-1))
+            if self.weight_decay != 0:
+                grad = grad.add(param, alpha=self.weight_decay)
+            param.sub_(lr*grad)
+        if self.step_mode == BUFFERED:
+            # AdaptDectectionLR.buffer_step
+            self.last_lr_grad += lr_grads/self.num_batch
+            torch._foreach_add_([self.hyper_buffer[name] for name in names], [grads[name] for name in names])
+        else:
+            # HyperGradientLR.step
+            self.lrs = torch.clamp(self.lrs+self.meta_lr*lr_grads, self.min_lr, self.max_lr)
+            torch._foreach_copy_([self.hyper_buffer[name] for name in names], [grads[name] for name in names])
+        return
+
+    @torch.no_grad()
+    def val(self):
+        preds = vmap(functional_call, in_dims=(None, 0, None))(self.base, (self.params, self.buffers), (self.x_test,))
+        labels = self.y_test.expand(self.num_replica, -1)
+        val_loss = F.cross_entropy(preds.flatten(0, 1), labels.flatten(), reduction="none").view(self.num_replica, -1).mean(1)
+        val_accu = preds.argmax(2).eq(labels).double().mean(1)
+        return val_accu, val_loss
+
+    def summary(self):
+        # one row per replica: its config and final epoch
+        rows = []
+        for config, records in zip(self.configs, self.records):
+            rows.append({**config, **records[-1]})
+        return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--dataset", default=IRIS, choices=[IRIS, WINE, CAR, AGARICUS])
+    parser.add_argument("--scheduler", default="ads", choices=["ads", "hd"])
+    parser.add_argument("--seeds", type=int, nargs="+", default=[0])
+    parser.add_argument("--meta-lrs", type=float, nargs="+", default=[None])
+    parser.add_argument("--max-lrs", type=float, nargs="+", default=[None])
+    parser.add_argument("--min-lrs", type=float, nargs="+", default=[None])
+    parser.add_argument("--lr", type=float, default=0.1)
+    parser.add_argument("--epochs", type=int, default=EPOCHS)
+    parser.add_argument("--full-batch", action="store_true")
+    parser.add_argument("--device", default=default_device())
+    args = parser.parse_args()
+    inputdim, nclass, train_data, test_data = Data(args.device).get(args.dataset)
+    configs = grid(args.seeds, args.meta_lrs, args.max_lrs, args.min_lrs)
+    sweep = Sweep(lambda: MLP(inputdim, nclass), configs, train_data, test_data,
+                  scheduler=AdaptDectectionLR if args.scheduler == "ads" else HyperGradientLR, lr=args.lr,
+                  batch_size=None if args.full_batch else NAME2BATCHSIZE[args.dataset], device=args.device)
+    st_time = time()
+    sweep.train(args.epochs)
+    print(f"Sweep->replicas:{sweep.num_replica}, steps:{args.epochs*sweep.num_batch}, time:{round(time()-st_time, 4)}")
+    for row in sweep.summary():
+        print(", ".join(f"{key}:{round(value, 6) if isinstance(value, float) else value}" for key, value in row.items() if key != "lrs"))
+    pass
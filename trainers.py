@@ -2,78 +2,325 @@ import pickle as pkl
 import json
 import warnings
 import numpy as np
+import math
+import contextlib
+import os
 import torch
+import torch.distributed as dist
 import torch.nn.functional as F
+from torch.nn.parallel import DistributedDataParallel
+from torch.utils.data import DistributedSampler
 from const import *
-from utils import Data, num_image
+from utils import Data, PhaseProfiler, Prefetcher, TensorLoader, BackgroundWriter, MetricsLogger, RunningMetrics, atomic_save, default_device, format_phases, init_distributed, num_image, rng_state, set_rng_state, shard_loader, snapshot
 from time import time
 from model.resnet import ResNet
+from model.mlp import MLP
 from torch.optim.lr_scheduler import *
 from model.adaptdetection import AdaptDectectionLR, AdaptDectectionAdamLR, AdaptDectectionMomentumLR
 warnings.filterwarnings("ignore")
+# the phase of an unprofiled trainer
+NOPHASE = contextlib.nullcontext()
+
+
+def scheduler_step_mode(scheduler):
+    # PER_EPOCH for torch schedulers, the adaptive schedulers declare PER_BATCH or BUFFERED
+    return getattr(scheduler, "step_mode", PER_EPOCH)
 
 
 class Trainer():
-    def __init__(self, dataset, device="cuda:0") -> None:
-        self.device = device
-        # data
+    # full epoch line only when val accuracy improves, time only otherwise
+    print_improved_only = False
+    model_name = "resnet"
+
+    def __init__(self, dataset, device=None, lr_log_interval=1, amp=None, compile=False, data_on_device=False, prefetch=None, distributed=False, ckpt_interval=1, metrics_path=None, metrics_interval=None, eval_folded=False, channels_last=False, profile=False, trace_dir=None, accumulation_steps=1, synthetic_images=None, checkpoint_path=None, backend=None) -> None:
+        # distributed joins (or reuses) a torch.distributed process group, every rank trains on its
+        # shard of the train set through DistributedDataParallel and only rank 0 prints. backend
+        # defaults to nccl for a cuda trainer and gloo for a cpu one (also on a gpu host)
+        self.device = device if device else default_device()
+        if distributed:
+            init_distributed(backend if backend else ("nccl" if torch.device(self.device).type == "cuda" else "gloo"))
+        self.distributed = dist.is_available() and dist.is_initialized()
+        self.rank = dist.get_rank() if self.distributed else 0
+        self.world_size = dist.get_world_size() if self.distributed else 1
+        self.lr_log_interval = lr_log_interval
+        # mixed precision, None, FP16 (with loss scaling) or BF16
+        self.amp = amp
+        # placement follows the given device, a cpu trainer stays on the cpu on a gpu host too
+        self.device_type = torch.device(self.device).type
+        if amp == FP16 and self.device_type != "cuda":
+            raise ValueError("fp16 mixed precision needs cuda, use bf16 on cpu")
+        self.scaler = torch.cuda.amp.GradScaler(enabled=amp == FP16)
+        # data, synthetic_images sizes the SYNTHETIC train set
+        st_time = time()
         self.dataset = dataset
-        self.train_loader, self.test_loader, self.input_channel, self.inputdim, self.nclass = Data().get(dataset)
+        self.synthetic_images = synthetic_images
+        self.load_data(data_on_device, prefetch)
         self.num_image = num_image(self.train_loader)
+        if self.distributed:
+            self.train_loader = shard_loader(self.train_loader, self.rank, self.world_size)
+            self.num_image = math.ceil(self.num_image/self.world_size)
+        # accumulation_steps micro-batches (the loader's batches) make one optimizer step, the
+        # effective batch. num_batch counts effective steps per epoch, the last partial one included,
+        # buffered schedulers average over it
+        self.accumulation_steps = accumulation_steps
+        self.num_micro_batch = len(self.train_loader)
+        self.num_batch = math.ceil(self.num_micro_batch/accumulation_steps)
         # model
-        self.model = ResNet(self.input_channel, self.inputdim, self.nclass)
-        if torch.cuda.is_available():
-            self.model.cuda(self.device)
-        self.save_model_path = f"ckpt/resnet_{self.dataset}"
+        self.model = self.build_model()
+        self.model.to(self.device)
+        # channels_last (NHWC) model and batches with cudnn autotuning. build the optimizer and the
+        # scheduler after this, their per-param state then takes the params' memory format
+        self.channels_last = channels_last
+        if channels_last:
+            self.model.to(memory_format=torch.channels_last)
+            torch.backends.cudnn.benchmark = True
+        self.save_model_path = f"ckpt/{self.model_name}_{self.dataset}"
+        # train(save=True) checkpoints everything a resume needs every ckpt_interval epochs, written
+        # atomically by a background thread, to checkpoint_path (default one per model and dataset)
+        self.checkpoint_path = checkpoint_path if checkpoint_path else f"{self.save_model_path}.ckpt"
+        self.ckpt_interval = ckpt_interval
+        self.writer = None
+        # epoch records (and a record every metrics_interval steps) appended to metrics_path, a .jsonl
+        # or .csv file, by a writer thread. between records the metrics stay on the device
+        self.metrics_logger = MetricsLogger(metrics_path) if metrics_path and self.rank == 0 else None
+        self.metrics_interval = metrics_interval
+        # profile times the phases of every step (data_wait, h2d, forward, backward, optimizer_step,
+        # scheduler_step, eval) and adds a per epoch breakdown to the records, trace_dir also runs
+        # torch.profiler over the first steps and writes chrome traces there. off, phases are no-ops
+        self.profiler = PhaseProfiler(self.device, trace_dir) \
+            if profile or trace_dir else None
+        # compile uses inductor (its cpu backend without cuda)
+        self.ddp_model = DistributedDataParallel(self.model, [self.device] if self.device_type == "cuda" else None) \
+            if self.distributed else self.model
+        self.forward_model = torch.compile(self.ddp_model) if compile else self.ddp_model
+        # val runs the model itself (no ddp collectives), or with eval_folded a copy with the
+        # batchnorms folded into the convs, rebuilt from the current weights at every val
+        self.eval_folded = eval_folded
+        if eval_folded and not hasattr(self.model, "fold_bn"):
+            raise ValueError(f"{type(self.model).__name__} has no batchnorm to fold")
         # optimizer and scheduler
         self.optimizer = None
         self.scheduler = None
+        # hook(trainer, epoch, batch_idx, loss) after every batch, hook(trainer, epoch, record) after every epoch
+        self.batch_hooks = []
+        self.epoch_hooks = []
+        self.startup_time = time()-st_time
+        if self.rank == 0:
+            print(f"Startup->images:{self.num_image}, batches:{self.num_batch}, time:{round(self.startup_time,4)}")
         pass
 
+    def load_data(self, data_on_device, prefetch):
+        self.train_loader, self.test_loader, self.input_channel, self.inputdim, self.nclass = \
+            Data(self.device, data_on_device, self.synthetic_images).get(self.dataset)
+        # host loaders are wrapped to prefetch batches to the device, DeviceLoaders already live there
+        if prefetch is None:
+            prefetch = NAME2PREFETCH.get(self.dataset, False)
+        if prefetch and self.device_type == "cuda" and not data_on_device:
+            self.train_loader = Prefetcher(self.train_loader, self.device)
+            self.test_loader = Prefetcher(self.test_loader, self.device)
+        return
+
+    def build_model(self):
+        return ResNet(self.input_channel, self.inputdim, self.nclass)
+
     def train(self, load=False, save=False, epochs=EPOCHS):
-        if load:
+        # load resumes from the checkpoint if there is one, else only loads the model weights
+        start_epoch, opt_accu = 0, -1
+        if load and os.path.exists(self.checkpoint_path):
+            start_epoch, opt_accu = self.load_checkpoint()
+        elif load:
             self.load_model()
-        opt_accu = -1
-        for i in range(epochs):
+        step_mode = scheduler_step_mode(self.scheduler)
+        metrics_device = self.device
+        if self.profiler is not None:
+            self.profiler.start()
+        for i in range(start_epoch, epochs):
             self.model.train()
-            loss_sum = 0
-            self.scheduler.step()
-            st_time = time()
-            for imgs, label in self.train_loader:
-                if torch.cuda.is_available():
-                    imgs = imgs.cuda(self.device)
-                    label = label.cuda(self.device)
-                preds = self.model(imgs)
-                loss = F.cross_entropy(preds, label)
-                self.optimizer.zero_grad()
-                loss.backward()
-                self.optimizer.step()
-                loss_sum += loss.item() * len(imgs)/self.num_image
+            if step_mode == PER_EPOCH:
+                self.scheduler.step()
+            loader = self.train_loader.loader if isinstance(self.train_loader, Prefetcher) else self.train_loader
+            if isinstance(getattr(loader, "sampler", None), DistributedSampler):
+                loader.sampler.set_epoch(i)
+            self.epoch_st_time = time()
+            metrics = RunningMetrics(metrics_device)
+            step_metrics = RunningMetrics(metrics_device) if self.metrics_interval else None
+            batches = self.profiler.iterate(self.train_loader) if self.profiler is not None else self.train_loader
+            for batch_idx, (imgs, label) in enumerate(batches):
+                with self.phase("h2d"):
+                    imgs, label = self.prepare_batch(imgs, label)
+                step, micro_idx = divmod(batch_idx, self.accumulation_steps)
+                num_micro = min(self.accumulation_steps, self.num_micro_batch-step*self.accumulation_steps)
+                loss = self.train_step(imgs, label, self.num_batch, num_micro, micro_idx, len(imgs)/self.step_images(step, num_micro))
+                metrics.add(loss, len(imgs))
+                if step_metrics is not None:
+                    step_metrics.add(loss, len(imgs))
+                    if micro_idx == num_micro-1 and (step+1) % self.metrics_interval == 0:
+                        self.log_metrics({"epoch": i+1, "step": step+1, **step_metrics.read(), "val_loss": None, "val_accu": None})
+                        step_metrics = RunningMetrics(metrics_device)
+                for hook in self.batch_hooks:
+                    hook(self, i, batch_idx, loss)
+                if self.profiler is not None:
+                    self.profiler.step()
+            train_metrics = metrics.read()
+            if step_mode == BUFFERED:
+                self.scheduler.step()
+            if step_mode != PER_EPOCH:
+                self.log_lr(i)
             # eval
-            val_accu, val_loss = self.val()
-            print(f"Epoch~{i+1}->train_loss:{round(loss_sum,4)}, val_loss:{round(val_loss, 4)}, val_accu:{round(val_accu, 4)}, time:{round(time()-st_time,4)}")
+            with self.phase("eval"):
+                val_accu, val_loss = self.val()
+            record = {"epoch": i+1, "step": self.num_batch, **train_metrics, "val_loss": val_loss, "val_accu": val_accu}
+            if self.profiler is not None:
+                phases = self.profiler.table()
+                record["phases"] = {name: total["seconds"] for name, total in phases.items()}
+                if self.rank == 0:
+                    print(format_phases(phases))
+            record = self.log_metrics(record)
+            if self.rank == 0 and (val_accu > opt_accu or not self.print_improved_only):
+                print(f"Epoch~{i+1}->train_loss:{round(record['train_loss'],4)}, val_loss:{round(val_loss, 4)}, val_accu:{round(val_accu, 4)}, time:{round(record['time'],4)}")
+            elif self.rank == 0:
+                print(f"Epoch~{i+1}->time:{round(record['time'],4)}")
             if val_accu > opt_accu:
                 opt_accu = val_accu
-            # else:
-            #     print(f"Epoch~{i+1}->time:{round(time()-st_time,4)}")
+            for hook in self.epoch_hooks:
+                hook(self, i, record)
+            if save and ((i+1) % self.ckpt_interval == 0 or i+1 == epochs):
+                self.save_checkpoint(i+1, opt_accu)
+        if self.profiler is not None:
+            self.profiler.stop()
+        if save and self.writer is not None:
+            self.writer.flush()
+        if self.metrics_logger is not None:
+            self.metrics_logger.flush()
         return
 
+    def train_step(self, imgs, label, num_batch, num_micro=1, micro_idx=0, weight=1):
+        # micro-batch micro_idx of an effective step of num_micro, weight is its share of the step's
+        # images. ddp all reduces the grads only in its last micro-batch
+        sync = self.ddp_model.no_sync() if self.distributed and micro_idx != num_micro-1 else NOPHASE
+        with sync:
+            with self.phase("forward"), self.autocast():
+                preds = self.forward_model(imgs)
+                loss = F.cross_entropy(preds, label)
+            stepped = self.backward_step(loss, num_micro, micro_idx, weight)
+        # schedulers only see steps the optimizer actually applied, once per effective step
+        if stepped:
+            step_mode = scheduler_step_mode(self.scheduler)
+            with self.phase("scheduler_step"):
+                if step_mode == PER_BATCH:
+                    self.scheduler.step()
+                elif step_mode == BUFFERED:
+                    self.scheduler.buffer_step(num_batch)
+        return loss
+
+    def step_images(self, step, num_micro):
+        # images of an effective step, only the epoch's last loader batch may be partial
+        start = step*self.accumulation_steps*self.train_loader.batch_size
+        return min(num_micro*self.train_loader.batch_size, self.num_image-start)
+
+    def phase(self, name):
+        # a named phase of the step when profiling, otherwise nothing
+        return self.profiler.phase(name) if self.profiler is not None else NOPHASE
+
+    @torch.inference_mode()
     def val(self):
+        # correct and loss sums stay on the device, one read back for the whole test set
         self.model.eval()
-        ncorrect = 0
+        if self.eval_folded:
+            model = self.model.fold_bn()
+        else:
+            model = self.model if self.distributed else self.forward_model
+        ncorrect = torch.zeros((), dtype=torch.long, device=self.device)
+        valloss = torch.zeros((), dtype=torch.double, device=ncorrect.device)
         nsample = 0
-        valloss = 0
         for imgs, label in self.test_loader:
-            if torch.cuda.is_available():
-                imgs = imgs.cuda(self.device)
-                label = label.cuda(self.device)
-            preds = self.model(imgs)
-            ncorrect += torch.sum(preds.max(1)[1].eq(label).double())
+            imgs, label = self.prepare_batch(imgs, label)
+            with self.autocast():
+                preds = model(imgs)
+            ncorrect += preds.argmax(1).eq(label).sum()
+            valloss += F.cross_entropy(preds, label, reduction="sum")
             nsample += len(label)
-            loss = F.cross_entropy(preds, label)
-            valloss += loss.item() * len(imgs)
-        valloss = valloss/nsample
-        return float((ncorrect/nsample).cpu()), valloss
+        ncorrect, valloss = torch.stack([ncorrect.double(), valloss]).tolist()
+        return ncorrect/nsample, valloss/nsample
+
+    def prepare_batch(self, imgs, label):
+        if self.device_type == "cuda":
+            imgs = imgs.cuda(self.device)
+            label = label.cuda(self.device)
+        if self.channels_last and imgs.dim() == 4:
+            imgs = imgs.contiguous(memory_format=torch.channels_last)
+        return imgs, label
+
+    def autocast(self):
+        # cpu autocast rejects fp16 even when disabled
+        return torch.autocast(self.device_type, dtype=torch.float16 if self.amp == FP16 else torch.bfloat16,
+                              enabled=self.amp is not None)
+
+    def backward_step(self, loss, num_micro=1, micro_idx=0, weight=1):
+        # returns whether the optimizer stepped. micro-batch losses (batch means) are weighted by
+        # their share of the step's images, so the grads accumulate as the mean over the effective
+        # step's images, and the optimizer steps after the last micro-batch, param.grad then holds the
+        # large batch grad the schedulers read. with amp the grads are unscaled before the step,
+        # so schedulers reading param.grad afterwards see true grads, and steps with inf/nan grads
+        # are skipped and must be skipped by the schedulers too
+        if micro_idx == 0:
+            self.optimizer.zero_grad()
+        if num_micro > 1:
+            loss = loss*weight
+        with self.phase("backward"):
+            if self.amp == FP16:
+                self.scaler.scale(loss).backward()
+            else:
+                loss.backward()
+        if micro_idx != num_micro-1:
+            return False
+        if self.amp is None:
+            with self.phase("optimizer_step"):
+                self.optimizer.step()
+            return True
+        if self.amp == BF16:
+            with self.phase("optimizer_step"):
+                grads = [param.grad for group in self.optimizer.param_groups for param in group["params"] if param.grad is not None]
+                if not torch.isfinite(torch.stack(torch._foreach_norm(grads)).sum()):
+                    return False
+                self.optimizer.step()
+            return True
+        with self.phase("optimizer_step"):
+            self.scaler.unscale_(self.optimizer)
+            scale = self.scaler.get_scale()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
+        # the scale only backs off when inf/nan grads made the scaler skip the step
+        return self.scaler.get_scale() >= scale
+
+    def log_lr(self, epoch):
+        # lrs only come back to the host every lr_log_interval epochs
+        if (epoch+1) % self.lr_log_interval != 0 or self.rank != 0:
+            return
+        print(",".join(str(lr) for lr in self.read_lr()))
+        return
+
+    def read_lr(self):
+        if hasattr(self.scheduler, "read_lr"):
+            return self.scheduler.read_lr()
+        return [float(group["lr"]) for group in self.optimizer.param_groups]
+
+    def log_metrics(self, record):
+        # completes a record with the per group lrs and hypergradients and hands it to the writer
+        record = {**record, "lrs": self.read_lr(),
+                  "lr_grads": self.scheduler.read_lr_grad() if hasattr(self.scheduler, "read_lr_grad") else None,
+                  "time": time()-self.epoch_st_time}
+        if self.metrics_logger is not None:
+            self.metrics_logger.log(record)
+        return record
+
+    def register_batch_hook(self, hook):
+        self.batch_hooks.append(hook)
+        return
+
+    def register_epoch_hook(self, hook):
+        self.epoch_hooks.append(hook)
+        return
 
     def set_optimizer(self, optimizer):
         self.optimizer = optimizer
@@ -98,89 +345,64 @@ class Trainer():
         self.model.load_state_dict(state_dict)
         return
 
-
-class HDTrainer(Trainer):
-    def train(self, load=False, save=False, epochs=EPOCHS):
-        if load:
-            self.load_model()
-        opt_accu = -1
-        for i in range(epochs):
-            self.model.train()
-            loss_sum = 0
-            st_time = time()
-            for imgs, label in self.train_loader:
-                if torch.cuda.is_available():
-                    imgs = imgs.cuda(self.device)
-                    label = label.cuda(self.device)
-                preds = self.model(imgs)
-                loss = F.cross_entropy(preds, label)
-                self.optimizer.zero_grad()
-                loss.backward()
-                self.optimizer.step()
-                self.scheduler.step()
-                loss_sum += loss.item() * len(imgs)/self.num_image
-            for group in self.optimizer.param_groups:
-                print(group["lr"])
-            # eval
-            val_accu, val_loss = self.val()
-            if val_accu > opt_accu:
-                opt_accu = val_accu
-                print(
-                    f"Epoch~{i+1}->train_loss:{round(loss_sum,4)}, val_loss:{round(val_loss, 4)}, val_accu:{round(val_accu, 4)}, time:{round(time()-st_time,4)}")
-            else:
-                print(f"Epoch~{i+1}->time:{round(time()-st_time,4)}")
+    def save_checkpoint(self, epoch, opt_accu, path=None):
+        # a host snapshot is taken here, serializing and writing it happen on the writer thread
+        if self.rank != 0:
+            return
+        checkpoint = snapshot({
+            "epoch": epoch, "opt_accu": opt_accu,
+            "model": self.model.state_dict(),
+            "optimizer": self.optimizer.state_dict(),
+            "scheduler": self.scheduler.state_dict(),
+            "scaler": self.scaler.state_dict(),
+            "rng": rng_state([self.train_loader, self.test_loader]),
+        })
+        path = path if path else self.checkpoint_path
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if self.writer is None:
+            self.writer = BackgroundWriter()
+        self.writer.submit(atomic_save, checkpoint, path)
         return
 
+    def load_checkpoint(self, path=None):
+        # restores a save_checkpoint, returns the number of finished epochs and the best val accuracy
+        checkpoint = torch.load(path if path else self.checkpoint_path, map_location="cpu")
+        self.model.load_state_dict(checkpoint["model"])
+        self.optimizer.load_state_dict(checkpoint["optimizer"])
+        self.scheduler.load_state_dict(checkpoint["scheduler"])
+        self.scaler.load_state_dict(checkpoint["scaler"])
+        set_rng_state(checkpoint["rng"], [self.train_loader, self.test_loader])
+        return checkpoint["epoch"], checkpoint["opt_accu"]
 
-class ADSTrainer(Trainer):
-    def __init__(self, dataset, device="cuda:0") -> None:
-        self.device = device
-        # data
-        self.dataset = dataset
-        self.train_loader, self.test_loader, self.input_channel, self.inputdim, self.nclass = Data().get(dataset)
-        self.num_image = num_image(self.train_loader)
-        # model
-        self.model = ResNet(self.input_channel, self.inputdim, self.nclass)
-        if torch.cuda.is_available():
-            self.model.cuda(self.device)
-        self.save_model_path = f"ckpt/resnet_{self.dataset}"
-        # optimizer and scheduler
-        self.optimizer = None
-        self.scheduler = None
-        pass
 
-    def train(self, load=False, save=False, epochs=EPOCHS):
-        if load:
-            self.load_model()
-        opt_accu = -1
-        for i in range(epochs):
-            self.model.train()
-            loss_sum = 0
-            st_time = time()
-            for imgs, label in self.train_loader:
-                if torch.cuda.is_available():
-                    imgs = imgs.cuda(self.device)
-                    label = label.cuda(self.device)
-                preds = self.model(imgs)
-                loss = F.cross_entropy(preds, label)
-                self.optimizer.zero_grad()
-                loss.backward()
-                self.optimizer.step()
-                self.scheduler.buffer_step(int(self.num_image/len(imgs)))
-                loss_sum += loss.item() * len(imgs)/self.num_image
-            self.scheduler.step()
-            for group in self.optimizer.param_groups:
-                print(group["lr"].item(), end=",")
-            print("")
-            # eval
-            val_accu, val_loss = self.val()
-            if val_accu > opt_accu:
-                opt_accu = val_accu
-                print(f"Epoch~{i+1}->train_loss:{round(loss_sum,4)}, val_loss:{round(val_loss, 4)}, val_accu:{round(val_accu, 4)}, time:{round(time()-st_time,4)}")
-            else:
-                print(f"Epoch~{i+1}->time:{round(time()-st_time,4)}")
+class TabularTrainer(Trainer):
+    # the uci datasets with an mlp. the splits stay on the device and TensorLoader slices them with
+    # on device permutations, full_batch trains on the whole split every step
+    model_name = "mlp"
+
+    def __init__(self, dataset, batch_size=None, full_batch=False, hidden_dims=[64, 64], **kwargs) -> None:
+        self.batch_size = None if full_batch else batch_size if batch_size else NAME2BATCHSIZE[dataset]
+        self.hidden_dims = hidden_dims
+        super(TabularTrainer, self).__init__(dataset, **kwargs)
         return
 
+    def load_data(self, data_on_device, prefetch):
+        self.inputdim, self.nclass, (x_train, y_train), (x_test, y_test) = Data(self.device).get(self.dataset)
+        self.train_loader = TensorLoader(x_train, y_train, self.batch_size, device=self.device)
+        self.test_loader = TensorLoader(x_test, y_test, shuffle=False, device=self.device)
+        return
+
+    def build_model(self):
+        return MLP(self.inputdim, self.nclass, self.hidden_dims)
+
+
+class HDTrainer(Trainer):
+    print_improved_only = True
+
+
+class ADSTrainer(Trainer):
+    print_improved_only = True
+
 
 if __name__ == "__main__":
     pass
@@ -2,22 +2,170 @@ from const import *
 import sklearn.preprocessing as sp
 from sklearn.model_selection import train_test_split
 from torchvision import datasets, transforms
-from torch.utils.data import DataLoader
+from torch.utils.data import DataLoader, TensorDataset, DistributedSampler, RandomSampler
 import torch
+import torch.distributed as dist
+import torch.nn.functional as F
+import contextlib
 import math
 import re
+import os
+import hashlib
 import pickle
+import csv
+import json
+import queue
+import random
+import threading
 import numpy as np
 import pandas as pd
+from time import perf_counter, time
+
+
+class ShardedLoader():
+    # sample order of the tensor loaders, optionally split over distributed ranks. every rank draws
+    # the same permutation from a shared seed and keeps every world_size-th sample, padded by wrapping
+    # around like DistributedSampler so that all ranks run the same number of batches
+    rank = 0
+    world_size = 1
+    generator = None
+
+    def shard(self, rank, world_size, seed=0):
+        self.rank = rank
+        self.world_size = world_size
+        self.generator = torch.Generator(device=self.device).manual_seed(seed)
+        return self
+
+    def order(self, length):
+        if self.shuffle:
+            order = torch.randperm(length, generator=self.generator, device=self.device)
+        else:
+            order = torch.arange(length, device=self.device)
+        if self.world_size == 1:
+            return order
+        order = torch.cat([order, order[:(-length) % self.world_size]])
+        return order[self.rank::self.world_size]
+
+    def __len__(self):
+        return math.ceil(math.ceil(len(self.dataset)/self.world_size)/self.batch_size)
+
+
+class DeviceLoader(ShardedLoader):
+    # the whole uint8 dataset as one tensor on the device (the gpu when there is one), shuffled by
+    # index and augmented/normalized as batched tensor ops, so there are no worker processes or PIL
+    # decoding
+    def __init__(self, images, labels, batch_size, mean, std, shuffle=True, augment=False, device="cpu", padding=4) -> None:
+        images = torch.as_tensor(images).permute(0, 3, 1, 2).contiguous()
+        labels = torch.as_tensor(labels, dtype=torch.long)
+        images, labels = images.to(device), labels.to(device)
+        self.dataset = TensorDataset(images, labels)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.augment = augment
+        self.padding = padding
+        self.device = images.device
+        # ToTensor's /255 folded into the normalization
+        self.mean = torch.tensor(mean, device=self.device).view(1, -1, 1, 1)*255
+        self.std = torch.tensor(std, device=self.device).view(1, -1, 1, 1)*255
+        return
+
+    def __iter__(self):
+        images, labels = self.dataset.tensors
+        order = self.order(len(images))
+        for start in range(0, len(order), self.batch_size):
+            index = order[start:start+self.batch_size]
+            imgs = images[index]
+            if self.augment:
+                imgs = self.random_crop_flip(imgs)
+            yield (imgs.float()-self.mean)/self.std, labels[index]
+
+    def random_crop_flip(self, imgs):
+        # RandomCrop(padding) with zero padding followed by RandomHorizontalFlip, per image
+        nimg, nchannel, height, width = imgs.size()
+        padded = F.pad(imgs, [self.padding]*4)
+        offset_y = torch.randint(0, 2*self.padding+1, (nimg, 1), device=self.device)
+        offset_x = torch.randint(0, 2*self.padding+1, (nimg, 1), device=self.device)
+        rows = (offset_y+torch.arange(height, device=self.device)).view(nimg, 1, height, 1)
+        cols = (offset_x+torch.arange(width, device=self.device)).view(nimg, 1, 1, width)
+        imgs = padded[torch.arange(nimg, device=self.device).view(nimg, 1, 1, 1),
+                      torch.arange(nchannel, device=self.device).view(1, nchannel, 1, 1), rows, cols]
+        flip = torch.rand(nimg, device=self.device) < 0.5
+        return torch.where(flip.view(nimg, 1, 1, 1), imgs.flip(3), imgs)
+
+
+class TensorLoader(ShardedLoader):
+    # minibatches of feature/label tensors that already live on the device, shuffled by an on device
+    # permutation so an epoch does no per batch host work. no batch_size yields the whole set at once
+    def __init__(self, inputs, labels, batch_size=None, shuffle=True, device="cpu") -> None:
+        inputs = torch.as_tensor(inputs, dtype=torch.float32).to(device)
+        labels = torch.as_tensor(labels).to(device, torch.long)
+        self.dataset = TensorDataset(inputs, labels)
+        self.batch_size = batch_size if batch_size else len(inputs)
+        self.shuffle = shuffle
+        self.device = inputs.device
+        return
+
+    def __iter__(self):
+        inputs, labels = self.dataset.tensors
+        if self.batch_size >= len(inputs) and self.world_size == 1:
+            # full batch, the order of the samples does not matter
+            yield inputs, labels
+            return
+        order = self.order(len(inputs))
+        for start in range(0, len(order), self.batch_size):
+            index = order[start:start+self.batch_size]
+            yield inputs[index], labels[index]
+
+
+class Prefetcher():
+    # wraps a loader and copies batch N+1 to the device on a side stream while batch N is computed.
+    # batches should come pinned (DataLoader(pin_memory=True)) for the copy to be asynchronous
+    def __init__(self, loader, device) -> None:
+        self.loader = loader
+        self.device = torch.device(device)
+        self.dataset = loader.dataset
+        self.batch_size = loader.batch_size
+        return
+
+    def __len__(self):
+        return len(self.loader)
+
+    def __iter__(self):
+        if self.device.type != "cuda":
+            yield from self.loader
+            return
+        stream = torch.cuda.Stream(self.device)
+        iterator = iter(self.loader)
+        batch = self.preload(iterator, stream)
+        while batch is not None:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            # the copies were allocated on the side stream but are used on the compute stream
+            for tensor in batch:
+                tensor.record_stream(current_stream)
+            next_batch = self.preload(iterator, stream)
+            yield batch
+            batch = next_batch
+
+    def preload(self, iterator, stream):
+        try:
+            batch = next(iterator)
+        except StopIteration:
+            return None
+        with torch.cuda.stream(stream):
+            return [tensor.to(self.device, non_blocking=True) for tensor in batch]
 
 
 class Data():
-    def __init__(self) -> None:
+    def __init__(self, device=None, on_device=False, synthetic_images=None) -> None:
         self.datasets = DATASETS
-        if torch.cuda.is_available():
-            self.device = "cuda:3"
-        else:
-            self.device = "cpu"
+        self.device = device if device else default_device()
+        # cifar as DeviceLoader instead of a worker based DataLoader
+        self.on_device = on_device
+        # host batches are pinned for a copy to a gpu only
+        self.pinned = torch.device(self.device).type == "cuda"
+        # train images of the synthetic dataset, default NUMIMAGE[SYNTHETIC]
+        self.synthetic_images = synthetic_images if synthetic_images else NUMIMAGE[SYNTHETIC]
         return
 
     def load_cifar10(self):
@@ -37,12 +185,21 @@ class Data():
                                          download=True)
         test_dataset = datasets.CIFAR10(root=data_root_path, train=False,
                                         transform=test_transform, download=True)
+        if self.on_device:
+            train_loader = DeviceLoader(train_dataset.data, train_dataset.targets, NAME2BATCHSIZE[CIFAR10],
+                                        CIFAR10MEAN, CIFAR10STD, augment=True, device=self.device)
+            test_loader = DeviceLoader(test_dataset.data, test_dataset.targets, EVALBATCHSIZE,
+                                       CIFAR10MEAN, CIFAR10STD, shuffle=False, device=self.device)
+            return train_loader, test_loader, 3, 32, 10
         train_loader = DataLoader(dataset=train_dataset,
                                   batch_size=NAME2BATCHSIZE[CIFAR10], shuffle=True,
-                                  num_workers=4,
+                                  num_workers=NAME2NUMWORKERS[CIFAR10], pin_memory=self.pinned,
+                                  persistent_workers=NAME2NUMWORKERS[CIFAR10] > 0,
                                   )
         test_loader = DataLoader(dataset=test_dataset,
-                                 batch_size=BATCHSIZE, shuffle=True,
+                                 batch_size=EVALBATCHSIZE, shuffle=False,
+                                 num_workers=NAME2NUMWORKERS[CIFAR10], pin_memory=self.pinned,
+                                 persistent_workers=NAME2NUMWORKERS[CIFAR10] > 0,
                                  )
         return train_loader, test_loader, 3, 32, 10
 
@@ -62,79 +219,108 @@ class Data():
                                           transform=train_transform, download=True)
         test_dataset = datasets.CIFAR100(root=data_root_path, train=False,
                                          transform=test_transform, download=True)
+        if self.on_device:
+            train_loader = DeviceLoader(train_dataset.data, train_dataset.targets, NAME2BATCHSIZE[CIFAR100],
+                                        CIFAR100MEAN, CIFAR100STD, augment=True, device=self.device)
+            test_loader = DeviceLoader(test_dataset.data, test_dataset.targets, EVALBATCHSIZE,
+                                       CIFAR100MEAN, CIFAR100STD, shuffle=False, device=self.device)
+            return train_loader, test_loader, 3, 32, 100
         train_loader = DataLoader(dataset=train_dataset,
                                   batch_size=NAME2BATCHSIZE[CIFAR100], shuffle=True,
-                                  num_workers=4,
+                                  num_workers=NAME2NUMWORKERS[CIFAR100], pin_memory=self.pinned,
+                                  persistent_workers=NAME2NUMWORKERS[CIFAR100] > 0,
                                   )
         test_loader = DataLoader(dataset=test_dataset,
-                                 batch_size=32, shuffle=True,
+                                 batch_size=EVALBATCHSIZE, shuffle=False,
+                                 num_workers=NAME2NUMWORKERS[CIFAR100], pin_memory=self.pinned,
+                                 persistent_workers=NAME2NUMWORKERS[CIFAR100] > 0,
                                  )
         return train_loader, test_loader, 3, 32, 100
 
+    def load_synthetic(self):
+        # synthetic_images normal noise images with uniform labels, a fixed seed and a quarter as many test images
+        generator = torch.Generator().manual_seed(0)
+        num_train = self.synthetic_images
+        images = torch.randn(num_train+num_train//4, 3, 32, 32, generator=generator)
+        labels = torch.randint(0, 10, (len(images),), generator=generator)
+        train_dataset = TensorDataset(images[:num_train], labels[:num_train])
+        test_dataset = TensorDataset(images[num_train:], labels[num_train:])
+        train_loader = DataLoader(dataset=train_dataset, batch_size=NAME2BATCHSIZE[SYNTHETIC], shuffle=True,
+                                  pin_memory=self.pinned)
+        test_loader = DataLoader(dataset=test_dataset, batch_size=EVALBATCHSIZE, shuffle=False,
+                                 pin_memory=self.pinned)
+        return train_loader, test_loader, 3, 32, 10
+
+    def load_tabular(self, name, path, encode, test_size=0.2, random_state=0):
+        # the encoded train/test split is cached as .npy files keyed by the source file hash and the
+        # split params, later runs memory map them instead of parsing and encoding the csv again.
+        # the key does not cover encode itself, remove TABULARCACHE after changing an encoding
+        with open(path, "rb") as f:
+            digest = hashlib.sha1(f.read()).hexdigest()
+        key = hashlib.sha1(f"{digest}:{test_size}:{random_state}".encode()).hexdigest()[:16]
+        prefix = os.path.join(TABULARCACHE, f"{name}-{key}")
+        names = ["x_train", "x_test", "y_train", "y_test"]
+        if not all(os.path.exists(f"{prefix}-{split}.npy") for split in names):
+            dataset = np.array(encode(pd.read_csv(path, header=None)), dtype=float).astype(np.float32)
+            splits = train_test_split(
+                dataset[:, :-1], dataset[:, -1], test_size=test_size, random_state=random_state)
+            os.makedirs(TABULARCACHE, exist_ok=True)
+            for split, array in zip(names, splits):
+                # written aside and renamed, so concurrent runs never read a partial file
+                tmp_path = f"{prefix}-{split}.{os.getpid()}.npy"
+                np.save(tmp_path, np.ascontiguousarray(array))
+                os.replace(tmp_path, f"{prefix}-{split}.npy")
+        # copy on write maps are writable, from_numpy shares their pages without a copy
+        tensors = [torch.from_numpy(np.load(f"{prefix}-{split}.npy", mmap_mode="c")) for split in names]
+        if torch.device(self.device).type == "cuda":
+            tensors = [tensor.to(self.device) for tensor in tensors]
+        x_train, x_test, y_train, y_test = tensors
+        return (x_train, y_train), (x_test, y_test)
+
     def load_iris(self):
         LabelIndex = 4
         path = "data/iris/iris.data"
-        df = pd.read_csv(path, header=None)
-        dataset = np.column_stack((df.values[:, :-1],
-                                  sp.LabelEncoder().fit_transform(
-            df[[LabelIndex]].values)))
-        dataset = np.array(dataset, dtype=float)
-        dataset = torch.Tensor(dataset)
-        if torch.cuda.is_available():
-            dataset = dataset.cuda()
-        x_train, x_test, y_train, y_test = train_test_split(
-            dataset[:, :-1], dataset[:, -1:].reshape(len(dataset)), test_size=0.2, random_state=0)
-        return 4, 3, (x_train, y_train), (x_test, y_test)
+
+        def encode(df):
+            return np.column_stack((df.values[:, :-1],
+                                    sp.LabelEncoder().fit_transform(df[[LabelIndex]].values)))
+        return 4, 3, *self.load_tabular(IRIS, path, encode)
 
     def load_wine(self):
         LabelIndex = 0
         path = "data/wine/wine.data"
-        df = pd.read_csv(path, header=None)
-        dataset = np.column_stack((df.values[:, 1:],
-                                   sp.LabelEncoder().fit_transform(df[[LabelIndex]].values)))
-        dataset = np.array(dataset, dtype=float)
-        dataset = torch.Tensor(dataset)
-        if torch.cuda.is_available():
-            dataset = dataset.cuda()
-        x_train, x_test, y_train, y_test = train_test_split(
-            dataset[:, :-1], dataset[:, -1:].reshape(len(dataset)), test_size=0.2, random_state=0)
-        return 13, 3, (x_train, y_train), (x_test, y_test)
+
+        def encode(df):
+            return np.column_stack((df.values[:, 1:],
+                                    sp.LabelEncoder().fit_transform(df[[LabelIndex]].values)))
+        return 13, 3, *self.load_tabular(WINE, path, encode)
 
     def load_car(self):
         LabelIndex = 6
         path = "data/car/car.data"
-        df = pd.read_csv(path, header=None)
-        dataset = np.column_stack((sp.OneHotEncoder(sparse=False).fit_transform(df.values[:, :-1]),
-                                   sp.LabelEncoder().fit_transform(df[[LabelIndex]].values)))
-        dataset = np.array(dataset, dtype=float)
-        dataset = torch.Tensor(dataset)
-        if torch.cuda.is_available():
-            dataset = dataset.cuda()
-        x_train, x_test, y_train, y_test = train_test_split(
-            dataset[:, :-1], dataset[:, -1:].reshape(len(dataset)), test_size=0.2, random_state=0)
-        return 21, 4, (x_train, y_train), (x_test, y_test)
+
+        def encode(df):
+            return np.column_stack((sp.OneHotEncoder(sparse=False).fit_transform(df.values[:, :-1]),
+                                    sp.LabelEncoder().fit_transform(df[[LabelIndex]].values)))
+        return 21, 4, *self.load_tabular(CAR, path, encode)
 
     def load_agaricus_lepiota(self):
         LabelIndex = 0
         path = "data/agaricus-lepiota/agaricus-lepiota.data"
-        df = pd.read_csv(path, header=None)
-        dataset = np.column_stack((sp.OneHotEncoder(sparse=False).fit_transform(df.values[:, 1:11]),
-                                   sp.OneHotEncoder(sparse=False).fit_transform(
-                                       df.values[:, 12:]),
-                                   sp.LabelEncoder().fit_transform(df[[LabelIndex]].values)))
-        dataset = np.array(dataset, dtype=float)
-        dataset = torch.Tensor(dataset)
-        if torch.cuda.is_available():
-            dataset = dataset.cuda()
-        x_train, x_test, y_train, y_test = train_test_split(
-            dataset[:, :-1], dataset[:, -1:].reshape(len(dataset)), test_size=0.2, random_state=0)
-        return 112, 2, (x_train, y_train), (x_test, y_test)
+
+        def encode(df):
+            return np.column_stack((sp.OneHotEncoder(sparse=False).fit_transform(df.values[:, 1:11]),
+                                    sp.OneHotEncoder(sparse=False).fit_transform(df.values[:, 12:]),
+                                    sp.LabelEncoder().fit_transform(df[[LabelIndex]].values)))
+        return 112, 2, *self.load_tabular(AGARICUS, path, encode)
 
     def get(self, dataset):
         if dataset == CIFAR10:
             return self.load_cifar10()
         if dataset == CIFAR100:
             return self.load_cifar100()
+        if dataset == SYNTHETIC:
+            return self.load_synthetic()
         if dataset == IRIS:
             return self.load_iris()
         if dataset == WINE:
@@ -146,7 +332,288 @@ class Data():
         return None
 
 
+def snapshot(value):
+    # host copy of every tensor in a (nested) state dict, safe to serialize while training goes on
+    if torch.is_tensor(value):
+        return value.detach().to("cpu", copy=True)
+    if isinstance(value, dict):
+        return {key: snapshot(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return type(value)(snapshot(item) for item in value)
+    return value
+
+
+def rng_state(loaders=()):
+    # every generator training draws from: torch (cpu, cuda), numpy, random and sharded loaders' own
+    state = {"torch": torch.get_rng_state(), "numpy": np.random.get_state(), "random": random.getstate(),
+             "loaders": [loader.generator.get_state() if getattr(loader, "generator", None) is not None else None
+                         for loader in loaders]}
+    if torch.cuda.is_available():
+        state["cuda"] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state, loaders=()):
+    torch.set_rng_state(state["torch"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["random"])
+    for loader, generator_state in zip(loaders, state["loaders"]):
+        if generator_state is not None:
+            loader.generator.set_state(generator_state)
+    if torch.cuda.is_available() and "cuda" in state:
+        torch.cuda.set_rng_state_all(state["cuda"])
+    return
+
+
+def atomic_save(obj, path):
+    # written aside, synced and renamed, so a crash leaves either the old or the new file
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return
+
+
+class BackgroundWriter():
+    # runs writes on a daemon thread in submission order, so the training loop only pays for the
+    # snapshot it hands over. flush() waits for everything submitted, errors surface on the next call
+    def __init__(self) -> None:
+        self.queue = queue.Queue()
+        self.error = None
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+        return
+
+    def work(self):
+        while True:
+            fn, args = self.queue.get()
+            try:
+                fn(*args)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    def submit(self, fn, *args) -> None:
+        self.raise_error()
+        self.queue.put((fn, args))
+        return
+
+    def flush(self) -> None:
+        self.queue.join()
+        self.raise_error()
+        return
+
+    def raise_error(self) -> None:
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+        return
+
+
+class RunningMetrics():
+    # sample weighted loss sum on the device with a host side sample count, adding a batch never
+    # syncs and read() is the only read back
+    def __init__(self, device) -> None:
+        self.loss_sum = torch.zeros((), device=device)
+        self.count = 0
+        self.st_time = time()
+        return
+
+    def add(self, loss, num) -> None:
+        self.loss_sum += loss.detach()*num
+        self.count += num
+        return
+
+    def read(self) -> dict:
+        loss = float(self.loss_sum)/max(self.count, 1)
+        return {"train_loss": loss, "images_per_sec": self.count/(time()-self.st_time)}
+
+
+class MetricsLogger():
+    # appends metric records as json lines, or as csv rows for a .csv path, on a writer thread.
+    # list and dict values (lrs, lr grads per group, phase times) become one csv column per entry
+    def __init__(self, path) -> None:
+        self.path = path
+        self.csv = path.endswith(".csv")
+        self.columns = None
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.writer = BackgroundWriter()
+        return
+
+    def log(self, record) -> None:
+        self.writer.submit(self.write, dict(record))
+        return
+
+    def write(self, record) -> None:
+        if not self.csv:
+            with open(self.path, "a") as f:
+                f.write(json.dumps(record)+"\n")
+            return
+        row = {}
+        for key, value in record.items():
+            if isinstance(value, (list, tuple)):
+                row.update({f"{key}_{i}": item for i, item in enumerate(value)})
+            elif isinstance(value, dict):
+                row.update({f"{key}_{name}": item for name, item in value.items()})
+            else:
+                row[key] = value
+        new_file = not os.path.exists(self.path) or os.path.getsize(self.path) == 0
+        if self.columns is None:
+            self.columns = []
+            if not new_file:
+                with open(self.path, newline="") as f:
+                    self.columns = next(csv.reader(f))
+        new_columns = [key for key in row if key not in self.columns]
+        if len(new_columns) != 0:
+            # a record with new keys (e.g. the phases of an epoch after step records) widens the
+            # header, the rows so far are rewritten with empty cells for them
+            self.columns += new_columns
+            rows = []
+            if not new_file:
+                with open(self.path, newline="") as f:
+                    rows = list(csv.DictReader(f))
+            with open(self.path+".tmp", "w", newline="") as f:
+                writer = csv.DictWriter(f, self.columns)
+                writer.writeheader()
+                writer.writerows(rows)
+            os.replace(self.path+".tmp", self.path)
+        with open(self.path, "a", newline="") as f:
+            csv.DictWriter(f, self.columns).writerow(row)
+        return
+
+    def flush(self) -> None:
+        self.writer.flush()
+        return
+
+
+class PhaseProfiler():
+    # wall clock (cpu) or cuda event (gpu) time of named phases of the train loop, summed per epoch.
+    # events are only read back by table(), once per epoch. with trace_dir a torch.profiler runs on
+    # the wait/warmup/active schedule over the train steps and writes a chrome trace per active window
+    def __init__(self, device, trace_dir=None, wait=1, warmup=1, active=3, repeat=1) -> None:
+        self.events = torch.device(device).type == "cuda"
+        self.trace_dir = trace_dir
+        self.profile = None
+        if trace_dir:
+            os.makedirs(trace_dir, exist_ok=True)
+            activities = [torch.profiler.ProfilerActivity.CPU]
+            if self.events:
+                activities.append(torch.profiler.ProfilerActivity.CUDA)
+            self.profile = torch.profiler.profile(
+                activities=activities, schedule=torch.profiler.schedule(wait=wait, warmup=warmup, active=active, repeat=repeat),
+                on_trace_ready=self.export, record_shapes=True, profile_memory=True, with_stack=False)
+        self.timings = {}
+        return
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        timing = self.timings.setdefault(name, [])
+        label = torch.profiler.record_function(name) if self.profile is not None else contextlib.nullcontext()
+        with label:
+            if self.events:
+                start, end = torch.cuda.Event(enable_timing=True), torch.cuda.Event(enable_timing=True)
+                start.record()
+                yield
+                end.record()
+                timing.append((start, end))
+            else:
+                st_time = perf_counter()
+                yield
+                timing.append(perf_counter()-st_time)
+        return
+
+    def iterate(self, loader):
+        # the loader's batches, the time spent waiting for each one as the data_wait phase
+        iterator = iter(loader)
+        while True:
+            with self.phase("data_wait"):
+                batch = next(iterator, None)
+            if batch is None:
+                return
+            yield batch
+
+    def start(self) -> None:
+        if self.profile is not None:
+            self.profile.start()
+        return
+
+    def step(self) -> None:
+        if self.profile is not None:
+            self.profile.step()
+        return
+
+    def stop(self) -> None:
+        if self.profile is not None:
+            self.profile.stop()
+        return
+
+    def export(self, profile) -> None:
+        profile.export_chrome_trace(os.path.join(self.trace_dir, f"trace_{profile.step_num}.json"))
+        return
+
+    def table(self) -> dict:
+        # phase -> total seconds, count and share of the phases' total since the last table()
+        if self.events:
+            torch.cuda.synchronize()
+        totals = {}
+        for name, timing in self.timings.items():
+            seconds = sum(start.elapsed_time(end)/1e3 for start, end in timing) if self.events else sum(timing)
+            totals[name] = {"seconds": seconds, "count": len(timing)}
+        overall = sum(total["seconds"] for total in totals.values())
+        for total in totals.values():
+            total["share"] = total["seconds"]/overall if overall > 0 else 0
+        self.timings = {}
+        return totals
+
+
+def format_phases(totals):
+    lines = [f"{'phase':<16}{'seconds':>10}{'count':>8}{'share':>8}"]
+    for name, total in totals.items():
+        lines.append(f"{name:<16}{total['seconds']:>10.4f}{total['count']:>8}{total['share']:>8.1%}")
+    return "\n".join(lines)
+
+
+def default_device():
+    # this process' gpu, the local rank's one when launched by torchrun, or the cpu
+    if torch.cuda.is_available():
+        return f"cuda:{int(os.environ.get('LOCAL_RANK', 0))}"
+    return "cpu"
+
+
+def init_distributed(backend=None):
+    # joins the process group described by torchrun's environment (RANK, WORLD_SIZE, MASTER_ADDR, ...).
+    # backend defaults to nccl with cuda and gloo otherwise, gloo also runs on cpu, nccl is faster between gpus
+    if backend is None:
+        backend = "nccl" if torch.cuda.is_available() else "gloo"
+    if not dist.is_initialized():
+        dist.init_process_group(backend)
+        if torch.cuda.is_available():
+            torch.cuda.set_device(default_device())
+    return dist.get_rank(), dist.get_world_size()
+
+
+def shard_loader(loader, rank, world_size):
+    # the rank's share of every epoch, the tensor loaders shard themselves, DataLoaders get a
+    # DistributedSampler (set_epoch reshuffles it)
+    if isinstance(loader, Prefetcher):
+        loader.loader = shard_loader(loader.loader, rank, world_size)
+        return loader
+    if isinstance(loader, ShardedLoader):
+        return loader.shard(rank, world_size)
+    sampler = DistributedSampler(loader.dataset, world_size, rank, shuffle=isinstance(loader.sampler, RandomSampler))
+    return DataLoader(dataset=loader.dataset, batch_size=loader.batch_size, sampler=sampler,
+                      num_workers=loader.num_workers, pin_memory=loader.pin_memory,
+                      persistent_workers=loader.persistent_workers)
+
+
 def num_image(loader):
+    # dataset size from its length, iterating the loader would decode and augment a whole epoch
+    if hasattr(loader.dataset, "__len__"):
+        return len(loader.dataset)
     res = 0
     for _, label in loader:
         res += len(label)